@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Union, Literal
+from typing import List, Optional, Union, Literal
 from pathlib import Path
 import yaml
 import json
@@ -23,6 +23,18 @@ class TrainingConfig(BaseModel):
     val_interval: int = Field(..., description="Interval (in steps) for validation.")
     device: str = Field(..., description="Computational device (e.g., 'cuda').")
     mixed_precision: str = Field(..., description="accelerator use bf16 or fp16 or no")
+    device_mels: bool = Field(
+        default=False,
+        description="Compute mel spectrograms for each batch on the training device instead of in the data loader workers.",
+    )
+    batch_profile_path: Optional[str] = Field(
+        default="~/.cache/stylish-tts/batch_sizes",
+        description="Directory of probed batch sizes shared between runs on the same GPU, model config, stage and precision. Set to null to always probe.",
+    )
+    keep_checkpoints: Optional[int] = Field(
+        default=None,
+        description="Number of the most recent periodic checkpoints to keep in each stage, in addition to the one with the best validation loss. Set to null to keep all of them.",
+    )
 
 
 class TrainingStageConfig(BaseModel):
@@ -35,6 +47,18 @@ class TrainingStageConfig(BaseModel):
         default=32, description="Maximum batch size to attempt during bin probing."
     )
     lr: float = Field(default=1e-4, description="General learning rate.")
+    frame_budget: Optional[int] = Field(
+        default=None,
+        description="If set, batches are packed from neighbouring time bins up to this many padded mel frames in total instead of using probed batch sizes per bin.",
+    )
+    max_padding: float = Field(
+        default=0.1,
+        description="Largest fraction of a segment's frames which may be padding when time bins are merged for frame_budget.",
+    )
+    accumulate_seconds: Optional[float] = Field(
+        default=None,
+        description="If set, gradients are summed over consecutive batches until they hold this many seconds of padded audio before each optimizer step, so the effective batch no longer depends on how many segments fit in memory.",
+    )
 
 
 class TrainingPlanConfig(BaseModel):
@@ -88,6 +112,10 @@ class DatasetConfig(BaseModel):
         ...,
         description="Path to the precomputed alignment safetensor file for your segments.",
     )
+    feature_path: Optional[str] = Field(
+        default=None,
+        description="Directory of precomputed feature shards from dataprep/feature_shards.py. Segments not found there are loaded from wav_path.",
+    )
 
 
 class LossWeightConfig(BaseModel):
@@ -1,6 +1,10 @@
 # IPA Phonemizer: https://github.com/bootphon/phonemizer
 # from config_loader import SymbolConfig
+import collections
 import logging
+from typing import List, Tuple
+
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
@@ -16,17 +20,72 @@ class TextCleaner:
             symbols.letters_ipa
         )  # "ɑɐɒæɓʙβɔɕçɗɖðʤəɘɚɛɜɝɞɟʄɡɠɢʛɦɧħɥʜɨɪʝɭɬɫɮʟɱɯɰŋɳɲɴøɵɸθœɶʘɹɺɾɻʀʁɽʂʃʈʧʉʊʋⱱʌɣɤʍχʎʏʑʐʒʔʡʕʢǀǁǂǃˈˌːˑʼʴʰʱʲʷˠˤ˞↓↑→↗↘'̩'ᵻ"
         self.word_index_dictionary = self.build_text_cleaner()
+        self.lookup = self.build_lookup()
+        # Unknown symbols seen so far and how often
+        self.unknown = collections.Counter()
         # logger.debug(len(dicts))
 
     def __call__(self, text):
-        indexes = []
-        for char in text:
-            try:
-                indexes.append(self.word_index_dictionary[char])
-            except KeyError:
-                logger.error("Meld " + char + ": " + text)
+        return self.encode(text).tolist()
+
+    def encode(self, text) -> np.ndarray:
+        """Token ids of text as int64, dropping unknown symbols"""
+        indexes = self.lookup_codepoints(self.codepoints(text))
+        known = indexes >= 0
+        if not known.all():
+            self.report_unknown([text], [known])
+            indexes = indexes[known]
         return indexes
 
+    def encode_batch(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Encode texts into a (batch, max_length) int64 array padded with the
+        pad token and an int64 array of lengths. Unknown symbols are dropped
+        and reported once for the whole batch.
+        """
+        if len(texts) == 0:
+            return np.zeros([0, 0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+        codepoints = self.codepoints("".join(texts))
+        indexes = self.lookup_codepoints(codepoints)
+        splits = np.cumsum([len(text) for text in texts])[:-1]
+        rows = np.split(indexes, splits)
+        known = [row >= 0 for row in rows]
+        if not all(k.all() for k in known):
+            self.report_unknown(texts, known)
+            rows = [row[k] for row, k in zip(rows, known)]
+
+        lengths = np.array([row.shape[0] for row in rows], dtype=np.int64)
+        result = np.zeros([len(rows), lengths.max(initial=0)], dtype=np.int64)
+        mask = np.arange(result.shape[1]) < lengths[:, np.newaxis]
+        result[mask] = np.concatenate(rows)
+        return result, lengths
+
+    def codepoints(self, text) -> np.ndarray:
+        return np.frombuffer(text.encode("utf-32-le"), dtype="<u4")
+
+    def lookup_codepoints(self, codepoints) -> np.ndarray:
+        # Codepoints beyond the table are clamped onto its last entry, an
+        # unused slot which maps to -1
+        codepoints = np.minimum(codepoints, self.lookup.shape[0] - 1)
+        return self.lookup[codepoints]
+
+    def report_unknown(self, texts, known):
+        unknown = collections.Counter()
+        for text, k in zip(texts, known):
+            for i in np.flatnonzero(~k):
+                unknown[text[i]] += 1
+        self.unknown.update(unknown)
+        symbols = ", ".join(f"{repr(c)} x{n}" for c, n in unknown.most_common())
+        logger.error(f"Dropped unknown symbols in {len(texts)} text(s): {symbols}")
+
+    def build_lookup(self) -> np.ndarray:
+        """Table from unicode codepoint to token id, -1 for unknown symbols"""
+        size = max(ord(c) for c in self.word_index_dictionary) + 2
+        lookup = np.full([size], -1, dtype=np.int64)
+        for char, index in self.word_index_dictionary.items():
+            lookup[ord(char)] = index
+        return lookup
+
     def build_text_cleaner(self):
         # Export all symbols:
         symbols = (
@@ -7,7 +7,13 @@ import torchaudio
 from einops import rearrange, reduce
 import train_context
 from stylish_lib.config_loader import Config
-from utils import length_to_mask, log_norm, print_gpu_vram
+from utils import (
+    duration_to_alignment,
+    length_to_mask,
+    log_norm,
+    print_gpu_vram,
+    sequence_mask,
+)
 
 
 class BatchContext:
@@ -25,6 +31,39 @@ class BatchContext:
         self.pitch_prediction = None
         self.energy_prediction = None
         self.duration_prediction = None
+        self.duration_alignment = None
+
+    def alignment(self, batch):
+        """
+        Dense (batch, tokens, frames) alignment expanded on the device from
+        the collated per-token durations. Frames are at half the mel rate.
+        """
+        if self.duration_alignment is None:
+            self.duration_alignment = duration_to_alignment(
+                batch.duration, batch.mel.shape[-1] // 2
+            )
+        return self.duration_alignment
+
+    def sample_lengths(self, batch):
+        """Audio samples of each segment, the rest of the batch is padding"""
+        return batch.mel_length * self.train.model_config.hop_length
+
+    def frame_mask(self, batch, frames):
+        """(batch, frames) mask of the mel frames which are not padding"""
+        return sequence_mask(batch.mel_length, frames)
+
+    def mask_padding(self, batch, prediction):
+        """
+        Silence the predicted audio past the end of each segment. Shorter
+        segments of a batch are padded with silence, so the prediction then
+        matches the ground truth in the padding for every loss.
+        """
+        audio = prediction.audio
+        mask = sequence_mask(self.sample_lengths(batch), audio.shape[-1])
+        prediction.audio = audio * mask.view(
+            mask.shape[0], *[1] * (audio.dim() - 2), -1
+        )
+        return prediction
 
     def text_encoding(self, texts: torch.Tensor, text_lengths: torch.Tensor):
         return self.model.text_encoder(texts, text_lengths)
@@ -76,12 +115,12 @@ class BatchContext:
         pitch = self.calculate_pitch(batch).detach()
         prediction = self.decoding(
             text_encoding,
-            batch.alignment,
+            self.alignment(batch),
             pitch,
             energy,
             style_embedding,
         )
-        return prediction
+        return self.mask_padding(batch, prediction)
 
     def textual_prediction_single(self, batch):
         text_encoding, _, _ = self.text_encoding(batch.text, batch.text_length)
@@ -95,19 +134,19 @@ class BatchContext:
             duration_encoding,
             prosody_embedding,
             batch.text_length,
-            batch.alignment,
+            self.alignment(batch),
             text_mask,
         )
-        prosody_embedding = prosody_embedding @ batch.alignment
+        prosody_embedding = prosody_embedding @ self.alignment(batch)
         self.pitch_prediction, self.energy_prediction = (
             self.model.pitch_energy_predictor(prosody, prosody_embedding)
         )
         pitch = self.calculate_pitch(batch, self.pitch_prediction)
         prediction = self.decoding(
             text_encoding,
-            batch.alignment,
+            self.alignment(batch),
             pitch,
             self.energy_prediction,
             style_embedding,
         )
-        return prediction
+        return self.mask_padding(batch, prediction)
@@ -3,7 +3,10 @@ import traceback
 import torch
 from typing import Optional, Dict, List
 from meldataset import (
+    DevicePrefetcher,
+    DynamicBatchSampler,
     FilePathDataset,
+    budget_groups,
     build_dataloader,
     get_frame_count,
     get_padded_time_bin,
@@ -16,6 +19,7 @@ import tqdm
 import logging
 from stylish_lib.config_loader import DatasetConfig
 from loss_log import LossLog
+from batch_sizes import BatchSizeController
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +58,8 @@ class BatchManager:
             model_config=train.model_config,
             pitch_path=dataset_config.pitch_path,
             alignment_path=dataset_config.alignment_path,
+            feature_path=dataset_config.feature_path,
+            device_mels=train.config.training.device_mels,
         )
         time_bins, time_per_bin = self.dataset.time_bins()
         self.time_bins: Dict[int, List[int]] = time_bins
@@ -63,13 +69,16 @@ class BatchManager:
             self.process_count = accelerator.num_processes
             accelerator.even_batches = False
         self.loader: DataLoader = None
+        self.sampler: Optional[DynamicBatchSampler] = None
         self.last_oom: int = -1
         self.skip_forward: bool = False
+        # Growing on one process would give the processes different batches
+        self.controller = BatchSizeController(grow=self.process_count == 1)
 
     def probe_loop(self, train) -> None:
         if self.process_count > 1:
             exit(
-                "--probe_batch must be run with accelerator num_processes set to 1. After running it, distribute the batch_sizes.json files to the log directories and run in DDP"
+                "--probe_batch must be run with accelerator num_processes set to 1. Run it once on this GPU and model config so the batch sizes are saved to training.batch_profile_path, or distribute the batch_sizes.json files to the log directories, and then run in DDP"
             )
 
         train.stage.reset_batch_sizes()
@@ -88,93 +97,190 @@ class BatchManager:
             leave=False,
             dynamic_ncols=True,
         )
+        # One loader with a persistent worker is pointed at each probe
+        loader = build_dataloader(
+            self.dataset,
+            self.time_bins,
+            num_workers=1,
+            device=self.device,
+            drop_last=True,
+            multispeaker=self.multispeaker,
+            probe_bin=time_keys[0],
+            probe_batch_size=1,
+            fields=train.stage.device_inputs(train),
+            persistent_workers=True,
+            train=train,
+        )
         for key in iterator:
             frame_count = get_frame_count(key)
             iterator.update(n=(frame_count - iterator.n))
-            last_bin = key
-            done = False
-            while not done:
-                try:
-                    if batch_size == 0:
-                        train.stage.set_batch_size(key, 0)
-                    elif batch_size > 0:
-                        iterator.set_postfix({"batch_size": str(batch_size)})
-                        loader = build_dataloader(
-                            self.dataset,
-                            self.time_bins,
-                            num_workers=1,
-                            device=self.device,
-                            drop_last=True,
-                            multispeaker=self.multispeaker,
-                            probe_bin=key,
-                            probe_batch_size=batch_size,
-                            train=train,
-                        )
-                        for _, batch in enumerate(loader):
-                            _ = train.stage.train_batch(batch, train, probing=True)
-                            break
-                        train.stage.set_batch_size(key, batch_size)
-                    done = True
-                except Exception as e:
-                    if "out of memory" in str(e) or "cufft" in str(e).lower():
-                        audio_length = (last_bin * 0.25) + 0.25
-                        iterator.clear()
-                        train.logger.info(
-                            f"TRAIN_BATCH OOM ({last_bin}) @ batch_size {batch_size}: audio_len {audio_length} total_audio_len {audio_length * batch_size}"
-                        )
-                        iterator.display()
-                        import gc
+            # Longer segments never fit more per batch than shorter ones did
+            probe_max = min(batch_size, len(self.time_bins[key]))
+            if probe_max > 0:
+                fits = self.probe_bin(key, probe_max, loader, iterator, train)
+                if fits < probe_max:
+                    batch_size = fits
+            train.stage.set_batch_size(key, batch_size)
+        self.log_skipped_audio(train, train.stage.batch_sizes, "due to OOM")
+        train.stage.save_batch_sizes()
+        iterator.close()
 
-                        train.stage.optimizer.zero_grad()
-                        gc.collect()
-                        torch.cuda.synchronize()
-                        torch.cuda.empty_cache()
-                        if batch_size > 0:
-                            batch_size -= 1
-                    else:
-                        iterator.close()
-                        logger.error("UNKNOWN EXCEPTION")
-                        logger.error("".join(traceback.format_exception(e)))
-                        raise e
+    def log_skipped_audio(self, train, batch_sizes, reason) -> None:
+        """Log how much audio is in bins with a batch size of 0"""
         total_skipped_time = 0.0
         total_used_time = 0.0
-        for key, value in train.stage.batch_sizes.items():
+        for key, value in batch_sizes.items():
             if value == 0:
                 total_skipped_time += self.time_per_bin.get(int(key), 0.0)
             else:
                 total_used_time += self.time_per_bin.get(int(key), 0.0)
         train.logger.info(
-                            f"Training on {total_used_time/3600:.2f}h of audio, skipping {total_skipped_time/3600:.2f}h of audio due to OOM"
-                        )
-        train.stage.save_batch_sizes()
-        iterator.close()
+            f"Training on {total_used_time/3600:.2f}h of audio, skipping {total_skipped_time/3600:.2f}h of audio {reason}"
+        )
+
+    def log_frame_budget(self, train) -> None:
+        """Report the bins whose segments are too long for the frame budget"""
+        batch_sizes = {}
+        for bins, batch_size in budget_groups(
+            self.time_bins.keys(), train.stage.frame_budget, train.stage.max_padding
+        ):
+            for key in bins:
+                batch_sizes[key] = batch_size
+        if 0 in batch_sizes.values():
+            self.log_skipped_audio(
+                train,
+                batch_sizes,
+                f"longer than frame_budget {train.stage.frame_budget}",
+            )
+
+    def probe_bin(self, key, max_batch_size, loader, iterator, train) -> int:
+        """
+        Largest batch size up to max_batch_size which trains on bin key
+        without running out of memory. Peak memory is measured at two batch
+        sizes and extrapolated linearly to the device's memory, then the
+        prediction is checked by probing until the largest size that fits
+        and the smallest that does not are next to each other. When the
+        prediction fits, the sizes above it are tried in growing steps.
+        """
+        fits = 0
+        fails = max_batch_size + 1
+        small = max(1, max_batch_size // 8)
+        large = max(small, max_batch_size // 2)
+        peaks = {}
+        for batch_size in sorted(set([small, large])):
+            peak = self.probe_batch(key, batch_size, loader, iterator, train)
+            if peak is None:
+                fails = batch_size
+                break
+            fits = batch_size
+            peaks[batch_size] = peak
+
+        guess = (fits + fails) // 2
+        step = 1
+        if len(peaks) == 2 and torch.cuda.is_available():
+            per_item = (peaks[large] - peaks[small]) / (large - small)
+            capacity = 0.9 * torch.cuda.get_device_properties(self.device).total_memory
+            if per_item > 0:
+                guess = int(large + (capacity - peaks[large]) / per_item)
+        while fails - fits > 1:
+            batch_size = min(max(guess, fits + 1), fails - 1)
+            if self.probe_batch(key, batch_size, loader, iterator, train) is None:
+                fails = batch_size
+            else:
+                fits = batch_size
+            guess = (fits + fails) // 2
+            if fails > max_batch_size:
+                # No failure to bisect towards yet, so step up in growing steps
+                guess = fits + step
+                step *= 2
+        return fits
+
+    def probe_batch(self, key, batch_size, loader, iterator, train) -> Optional[int]:
+        """Peak memory of training one batch, or None if it ran out"""
+        iterator.set_postfix({"batch_size": str(batch_size)})
+        loader.batch_sampler.probe_batch(key, batch_size)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            for _, batch in enumerate(loader):
+                train.stage.train_batch(batch, train, probing=True)
+                break
+        except Exception as e:
+            if "out of memory" in str(e) or "cufft" in str(e).lower():
+                audio_length = (key * 0.25) + 0.25
+                iterator.clear()
+                train.logger.info(
+                    f"TRAIN_BATCH OOM ({key}) @ batch_size {batch_size}: audio_len {audio_length} total_audio_len {audio_length * batch_size}"
+                )
+                iterator.display()
+                train.stage.reset_accumulation()
+                gc.collect()
+                torch.cuda.synchronize()
+                torch.cuda.empty_cache()
+                return None
+            iterator.close()
+            logger.error("UNKNOWN EXCEPTION")
+            logger.error("".join(traceback.format_exception(e)))
+            raise e
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated()
+        return 0
 
     def init_epoch(self, train, should_fast_forward=False) -> None:
+        # Sliced feature shards need far less CPU than decoding wavs and
+        # computing mels in every worker
+        num_workers = 32
+        if self.dataset.features is not None:
+            num_workers = 8
         self.loader = build_dataloader(
             self.dataset,
             self.time_bins,
-            num_workers=32,
+            num_workers=num_workers,
             device=self.device,
             drop_last=True,
             multispeaker=self.multispeaker,
             epoch=train.manifest.current_epoch,
+            fields=train.stage.device_inputs(train),
             train=train,
         )
-        train.manifest.steps_per_epoch = train.stage.get_steps_per_epoch()
-        self.loader = train.accelerator.prepare(self.loader)
+        self.sampler = self.loader.batch_sampler
+        if train.stage.frame_budget is not None:
+            self.log_frame_budget(train)
         if should_fast_forward:
-            self.loader = train.accelerator.skip_first_batches(
-                self.loader, train.manifest.current_step
-            )
+            # The sampler skips straight to the step instead of the loader
+            # loading every batch before it
+            self.sampler.start_batch = train.manifest.current_step
+        train.manifest.steps_per_epoch = train.stage.get_steps_per_epoch()
+        # Batches are moved to the device by DevicePrefetcher instead
+        self.loader = train.accelerator.prepare_data_loader(
+            self.loader, device_placement=False
+        )
+        self.loader = DevicePrefetcher(
+            self.loader, self.device, train.stage.device_inputs(train)
+        )
         self.last_oom = -1
         self.skip_forward = False
 
+    def log_padding(self, train) -> None:
+        batches, frames, padding = self.sampler.take_padding_report()
+        if batches == 0:
+            return
+        train.logger.info(
+            f"Epoch had {batches} batches of {frames:.0f} frames on average, {padding * 100:.1f}% of them padding"
+        )
+        if train.accelerator.is_main_process:
+            step = train.manifest.current_total_step
+            train.writer.add_scalar("train/batch_frames", frames, step)
+            train.writer.add_scalar("train/padding", padding, step)
+
     def train_iterate(
         self, batch, train, progress_bar=None, debug=False
     ) -> Optional[LossLog]:
         result = None
         max_attempts = 3
-        last_bin = get_padded_time_bin(batch[0].shape[-1], self.hop_length)
+        # Stages which do not use audio leave it out of the batch
+        frames = int(batch[6].max())
+        last_bin = get_padded_time_bin(frames * self.hop_length, self.hop_length)
         if last_bin == -1 or (last_bin == self.last_oom and self.skip_forward):
             return result
         elif last_bin != self.last_oom:
@@ -189,10 +295,21 @@ class BatchManager:
                         f"train_batch(i={train.manifest.current_step}, batch={batch_size}, steps={train.manifest.current_total_step}), segment_bin_length={audio_length}, total_audio_in_batch={batch_size * audio_length}"
                     )
                     progress_bar.display() if progress_bar is not None else None
-                result = train.stage.train_batch(batch, train)
+                self.controller.begin_batch()
+                result, stepped = train.stage.train_batch(batch, train)
+                stage_config = train.config.training_plan.get_stage(train.stage.name)
+                self.controller.observe(
+                    train.stage,
+                    last_bin,
+                    len(batch[6]),
+                    get_frame_count(last_bin),
+                    stage_config.probe_batch_max,
+                )
                 break
             except Exception as e:
                 batch_size = train.stage.get_batch_size(last_bin)
+                if train.stage.frame_budget is not None:
+                    batch_size = len(batch[6])
                 audio_length = (last_bin * 0.25) + 0.25
                 if "CUDA out of memory" in str(e) or "cufft" in str(e).lower():
                     progress_bar.clear() if progress_bar is not None else None
@@ -204,24 +321,30 @@ class BatchManager:
                     progress_bar.display() if progress_bar is not None else None
                     if attempt >= max_attempts:
                         self.skip_forward = True
-                    train.stage.optimizer.zero_grad()
+                    # Part of the batch may have reached the gradients
+                    train.stage.reset_accumulation()
                     if self.last_oom != last_bin:
                         self.last_oom = last_bin
-                        if batch_size > 1:
-                            batch_size -= 1
-                        train.stage.set_batch_size(last_bin, batch_size)
-                        train.stage.save_batch_sizes()
+                        self.controller.shrink(
+                            train.stage,
+                            last_bin,
+                            batch_size,
+                            get_frame_count(last_bin),
+                        )
                     gc.collect()
                     torch.cuda.synchronize()
                     torch.cuda.empty_cache()
                 else:
                     logger.error("".join(traceback.format_exception(e)))
                     raise e
-        step = (
-            train.manifest.current_step
-            + (train.manifest.current_epoch - 1) * train.manifest.steps_per_epoch
-        )
-        step_limit = train.stage.max_epoch * train.manifest.steps_per_epoch
-        train.stage.optimizer.scheduler(step, step_limit, train.manifest.stage)
-        train.stage.optimizer.step_discriminator_schedulers()
+        # Learning rates only change when the optimizers step, not on
+        # batches which accumulate gradients
+        if result is not None and stepped:
+            step = (
+                train.manifest.current_step
+                + (train.manifest.current_epoch - 1) * train.manifest.steps_per_epoch
+            )
+            step_limit = train.stage.max_epoch * train.manifest.steps_per_epoch
+            train.stage.optimizer.scheduler(step, step_limit, train.manifest.stage)
+            train.stage.optimizer.step_discriminator_schedulers()
         return result
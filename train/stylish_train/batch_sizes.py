@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+import os.path as osp
+from typing import Dict, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class BatchProfileStore:
+    """
+    Probed batch sizes shared between training runs. A profile is keyed on
+    the GPU model and memory, a hash of the model config, the stage, the
+    mixed precision setting and the probe's batch size cap, so a new run on
+    the same hardware and config can start without probing. Each profile
+    is its own JSON file in path and is replaced atomically, so runs
+    sharing the store do not clash.
+    """
+
+    def __init__(self, path):
+        self.path = osp.expanduser(path)
+
+    def key(
+        self, *, device, model_config, stage, mixed_precision, probe_batch_max
+    ) -> dict:
+        device = torch.device(device)
+        gpu = "cpu"
+        memory = 0
+        if device.type == "cuda" and torch.cuda.is_available():
+            properties = torch.cuda.get_device_properties(device)
+            gpu = properties.name
+            memory = properties.total_memory
+        model = json.dumps(model_config.model_dump(), sort_keys=True)
+        return {
+            "gpu": gpu,
+            "memory": memory,
+            "model_config": hashlib.sha256(model.encode("utf-8")).hexdigest(),
+            "stage": stage,
+            "mixed_precision": mixed_precision,
+            "probe_batch_max": probe_batch_max,
+        }
+
+    def profile_file(self, key) -> str:
+        name = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8"))
+        return osp.join(self.path, f"{name.hexdigest()}.json")
+
+    def get(self, key) -> Optional[Dict[str, int]]:
+        path = self.profile_file(key)
+        if not osp.isfile(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                profile = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read batch size profile {path}: {e}")
+            return None
+        if profile.get("key") != key:
+            return None
+        return profile["batch_sizes"]
+
+    def put(self, key, batch_sizes: Dict[str, int]) -> None:
+        path = self.profile_file(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"key": key, "batch_sizes": batch_sizes}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write batch size profile {path}: {e}")
+
+
+class BatchSizeController:
+    """
+    Adjusts the stage's batch sizes in memory while training. The OOM
+    handler calls shrink, which takes one segment out of the failing bin's
+    batch size (or out of the frame budget). Successful batches are passed
+    to observe, and a bin grows by one segment after grow_after full
+    batches in a row whose peak memory leaves room for it under headroom.
+    Every shrink of a bin doubles the streak it needs to grow again, so a
+    bin recovers from a transient OOM without flapping. Changes reach the
+    sampler through the stage and are only written out by save, which is
+    called at checkpoints.
+    """
+
+    def __init__(self, *, grow=True, grow_after=200, headroom=0.1):
+        self.grow = grow
+        self.grow_after = grow_after
+        self.headroom = headroom
+        self.stage_name = None
+        self.streaks = {}
+        self.shrinks = {}
+        self.dirty = False
+
+    def reset(self, stage) -> None:
+        if stage.name != self.stage_name:
+            self.stage_name = stage.name
+            self.streaks = {}
+            self.shrinks = {}
+
+    def begin_batch(self) -> None:
+        if self.grow and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def shrink(self, stage, key, batch_size, frame_count) -> None:
+        self.reset(stage)
+        self.streaks[key] = 0
+        self.shrinks[key] = self.shrinks.get(key, 0) + 1
+        if stage.frame_budget is not None:
+            stage.set_frame_budget(max(stage.frame_budget - frame_count, frame_count))
+        else:
+            stage.set_batch_size(key, max(batch_size - 1, 1))
+        self.dirty = True
+
+    def observe(self, stage, key, batch_size, frame_count, max_batch_size) -> None:
+        self.reset(stage)
+        if not self.grow or not torch.cuda.is_available():
+            return
+        if stage.frame_budget is None and batch_size != stage.get_batch_size(key):
+            # A partial batch says nothing about the next size up
+            return
+        capacity = (1 - self.headroom) * torch.cuda.get_device_properties(
+            torch.cuda.current_device()
+        ).total_memory
+        peak = torch.cuda.max_memory_allocated()
+        if peak * (batch_size + 1) / batch_size > capacity:
+            self.streaks[key] = 0
+            return
+        self.streaks[key] = self.streaks.get(key, 0) + 1
+        if self.streaks[key] < self.grow_after * 2 ** self.shrinks.get(key, 0):
+            return
+        self.streaks[key] = 0
+        if stage.frame_budget is not None:
+            stage.set_frame_budget(stage.frame_budget + frame_count)
+        elif batch_size < max_batch_size:
+            stage.set_batch_size(key, batch_size + 1)
+        else:
+            return
+        self.dirty = True
+
+    def save(self, stage) -> None:
+        if self.dirty and stage.frame_budget is None:
+            stage.save_batch_sizes()
+        self.dirty = False
@@ -0,0 +1,299 @@
+import copy
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path as osp
+import random
+import re
+import shutil
+import threading
+from typing import Optional
+
+import numpy as np
+from safetensors.torch import save as save_safetensors
+import torch
+
+logger = logging.getLogger(__name__)
+
+checkpoint_pattern = re.compile(r"checkpoint_\d+_step_\d+")
+record_name = "checkpoints.json"
+
+
+class CheckpointWriter:
+    """
+    Writes accelerator checkpoints without stalling training. save copies
+    the model, optimizer, scheduler, scaler, rng and registered states to
+    host memory and returns; a worker thread then writes them into a
+    temporary directory which is renamed into place once complete. The
+    files use the names Accelerator.save_state gives them, with model
+    weights as safetensors, so accelerator.load_state reads them as before.
+    Only one checkpoint is in flight at a time and the pinned host buffers
+    are reused between saves. With several processes the model states have
+    to be gathered, so this falls back to a synchronous save_state.
+
+    When keep is set, only the keep most recent periodic checkpoints in a
+    stage's directory are kept, along with the one with the best
+    validation loss, which is recorded in checkpoints.json.
+
+    With a blob_dir, model and optimizer files are stored once in it under
+    the hash of their contents and hard linked into each checkpoint, so a
+    module which did not change between saves (such as one a stage only
+    evaluates) costs no disk space or write time. Whether the tensors
+    changed is told from their data pointers and version counters, which
+    every in-place update bumps, so unchanged files are not even copied to
+    the host. An optimizer counts as unchanged while its state tensors are,
+    as the scheduler sets new learning rates in its param groups on every
+    step. Blobs no checkpoint links to any more are removed.
+    """
+
+    def __init__(
+        self,
+        accelerator,
+        *,
+        keep: Optional[int] = None,
+        blob_dir: Optional[str] = None,
+    ):
+        self.accelerator = accelerator
+        self.keep = keep
+        self.blob_dir = blob_dir
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[Exception] = None
+        self.staging = {}
+        # file name -> (fingerprint, blob name) of the last save
+        self.blobs = {}
+
+    def save(self, path: str, *, loss: Optional[float] = None) -> None:
+        self.wait()
+        if self.accelerator.num_processes > 1:
+            self.accelerator.save_state(path, safe_serialization=False)
+            if self.accelerator.is_main_process:
+                self.retain(path, loss)
+            logger.info(f"Saved checkpoint to {path}")
+            return
+        files, fingerprints = self.snapshot()
+        self.thread = threading.Thread(
+            target=self.write, args=(path, files, fingerprints, loss)
+        )
+        self.thread.start()
+
+    def wait(self) -> None:
+        """Block until the checkpoint being written is on disk"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def forget(self) -> None:
+        """
+        Drop the fingerprints of the last save. Moving a module between
+        devices makes new tensors whose pointers and versions may match
+        the old ones, so this is called whenever models are moved.
+        """
+        self.wait()
+        self.blobs = {}
+
+    def snapshot(self):
+        accelerator = self.accelerator
+        files = {}
+        fingerprints = {}
+        for i, model in enumerate(accelerator._models):
+            name = "model.safetensors" if i == 0 else f"model_{i}.safetensors"
+            state = accelerator.get_state_dict(model, unwrap=False)
+            self.add_blob_file(files, fingerprints, name, state)
+        for i, optimizer in enumerate(accelerator._optimizers):
+            name = "optimizer.bin" if i == 0 else f"optimizer_{i}.bin"
+            state = optimizer.state_dict()
+            self.add_blob_file(files, fingerprints, name, state, state["state"])
+        for i, scheduler in enumerate(accelerator._schedulers):
+            name = "scheduler.bin" if i == 0 else f"scheduler_{i}.bin"
+            files[name] = self.to_host(name, scheduler.state_dict())
+        if accelerator.scaler is not None:
+            files["scaler.pt"] = self.to_host(
+                "scaler.pt", accelerator.scaler.state_dict()
+            )
+        for i, obj in enumerate(accelerator._custom_objects):
+            name = f"custom_checkpoint_{i}.pkl"
+            files[name] = self.to_host(name, obj.state_dict())
+        rng_states = {
+            "step": accelerator.step,
+            "random_state": random.getstate(),
+            "numpy_random_seed": np.random.get_state(),
+            "torch_manual_seed": torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            rng_states["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+            # Wait for the copies into the pinned buffers
+            torch.cuda.synchronize()
+        files[f"random_states_{accelerator.process_index}.pkl"] = rng_states
+        return files, fingerprints
+
+    def add_blob_file(self, files, fingerprints, name, state, tracked=None) -> None:
+        """
+        Add state as the file name, or None if it is unchanged since the last
+        save. Only changes to tracked, all of state by default, count.
+        """
+        if self.blob_dir is not None:
+            fingerprint = state_fingerprint(state if tracked is None else tracked)
+            fingerprints[name] = fingerprint
+            cached = self.blobs.get(name)
+            if (
+                cached is not None
+                and cached[0] == fingerprint
+                and osp.isfile(osp.join(self.blob_dir, cached[1]))
+            ):
+                # Unchanged since the last save, link the same blob
+                files[name] = None
+                return
+        files[name] = self.to_host(name, state)
+
+    def to_host(self, key, value):
+        if isinstance(value, torch.Tensor):
+            return self.staging_copy(key, value.detach())
+        if isinstance(value, dict):
+            return type(value)(
+                (k, self.to_host(f"{key}.{k}", v)) for k, v in value.items()
+            )
+        if isinstance(value, list):
+            return [self.to_host(f"{key}.{i}", v) for i, v in enumerate(value)]
+        if type(value) is tuple:
+            return tuple(self.to_host(f"{key}.{i}", v) for i, v in enumerate(value))
+        return copy.deepcopy(value)
+
+    def staging_copy(self, key, tensor: torch.Tensor) -> torch.Tensor:
+        if tensor.device.type == "cpu":
+            return tensor.clone(memory_format=torch.contiguous_format)
+        buffer = self.staging.get(key)
+        if (
+            buffer is None
+            or buffer.shape != tensor.shape
+            or buffer.dtype != tensor.dtype
+        ):
+            buffer = torch.empty(
+                tensor.shape, dtype=tensor.dtype, pin_memory=tensor.is_cuda
+            )
+            self.staging[key] = buffer
+        buffer.copy_(tensor, non_blocking=tensor.is_cuda)
+        return buffer
+
+    def write(self, path, files, fingerprints, loss) -> None:
+        tmp_path = f"{path}.tmp"
+        try:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            linked = self.blob_dir is not None and self.can_link(tmp_path)
+            for name, state in files.items():
+                file_path = osp.join(tmp_path, name)
+                if name in fingerprints and linked:
+                    self.write_blob(name, state, fingerprints[name], file_path)
+                elif state is None:
+                    # Unchanged, but its blob can not be linked
+                    blob = self.blobs[name][1]
+                    shutil.copyfile(osp.join(self.blob_dir, blob), file_path)
+                else:
+                    with open(file_path, "wb") as f:
+                        f.write(serialize(name, state))
+            if self.blob_dir is not None and not linked:
+                self.blob_dir = None
+                self.blobs = {}
+            if osp.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+            self.retain(path, loss)
+            if self.blob_dir is not None:
+                self.collect_blobs()
+            logger.info(f"Saved checkpoint to {path}")
+        except Exception as e:
+            logger.error(f"Failed to write checkpoint {path}: {e}")
+            self.error = e
+
+    def write_blob(self, name, state, fingerprint, file_path) -> None:
+        if state is None:
+            blob = self.blobs[name][1]
+        else:
+            data = serialize(name, state)
+            blob = hashlib.sha256(data).hexdigest() + osp.splitext(name)[1]
+            blob_path = osp.join(self.blob_dir, blob)
+            if not osp.isfile(blob_path):
+                os.makedirs(self.blob_dir, exist_ok=True)
+                with open(blob_path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(blob_path + ".tmp", blob_path)
+        os.link(osp.join(self.blob_dir, blob), file_path)
+        self.blobs[name] = (fingerprint, blob)
+
+    def can_link(self, tmp_path) -> bool:
+        """Whether blobs can be hard linked into the checkpoint at tmp_path"""
+        os.makedirs(self.blob_dir, exist_ok=True)
+        # Named like an unfinished blob so collect_blobs leaves it alone
+        probe_path = osp.join(self.blob_dir, "link_probe.tmp")
+        with open(probe_path, "wb"):
+            pass
+        try:
+            os.link(probe_path, osp.join(tmp_path, "link_probe"))
+            os.remove(osp.join(tmp_path, "link_probe"))
+            return True
+        except OSError as e:
+            logger.warning(
+                f"Could not link checkpoint blobs from {self.blob_dir} ({e}), writing full checkpoints instead"
+            )
+            return False
+        finally:
+            os.remove(probe_path)
+
+    def collect_blobs(self) -> None:
+        for name in os.listdir(self.blob_dir):
+            blob_path = osp.join(self.blob_dir, name)
+            if name.endswith(".tmp") or os.stat(blob_path).st_nlink > 1:
+                continue
+            os.remove(blob_path)
+            for key, (_, blob) in list(self.blobs.items()):
+                if blob == name:
+                    del self.blobs[key]
+
+    def retain(self, path, loss) -> None:
+        out_dir = osp.dirname(path)
+        record_path = osp.join(out_dir, record_name)
+        record = {}
+        if osp.isfile(record_path):
+            with open(record_path, "r") as f:
+                record = json.load(f)
+        if loss is not None and loss < record.get("best_loss", float("inf")):
+            record = {"best": osp.basename(path), "best_loss": loss}
+            with open(record_path + ".tmp", "w") as f:
+                json.dump(record, f)
+            os.replace(record_path + ".tmp", record_path)
+        if self.keep is None:
+            return
+        # Names are zero padded, so they sort by epoch and step
+        names = sorted(
+            name
+            for name in os.listdir(out_dir)
+            if checkpoint_pattern.fullmatch(name) and osp.isdir(osp.join(out_dir, name))
+        )
+        stale = names[: max(len(names) - self.keep, 0)]
+        for name in stale:
+            if name != record.get("best"):
+                shutil.rmtree(osp.join(out_dir, name), ignore_errors=True)
+
+
+def serialize(name, state) -> bytes:
+    if name.endswith(".safetensors"):
+        return save_safetensors(state, metadata={"format": "pt"})
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    return buffer.getvalue()
+
+
+def state_fingerprint(state) -> tuple:
+    """Identify the current contents of the tensors in a state dict"""
+    if isinstance(state, torch.Tensor):
+        return (state.data_ptr(), state._version)
+    if isinstance(state, dict):
+        return tuple((k, state_fingerprint(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return tuple(state_fingerprint(v) for v in state)
+    return repr(state)
@@ -1,3 +1,4 @@
+import logging
 import os
 import os.path as osp
 import random
@@ -13,54 +14,194 @@ from utils import length_to_mask, log_norm, maximum_path
 from models.models import build_model
 from stylish_lib.config_loader import Config, load_model_config_yaml
 from stylish_lib.text_utils import TextCleaner
-from models.export_model import ExportModel
+from models.export_model import (
+    ExportModel,
+    BatchedExportModel,
+    ExportFrontEnd,
+    ExportVocoder,
+)
 from models.stft import STFT
 
 from attr import attr
 import numpy as np
+import onnxruntime as ort
 from scipy.io.wavfile import write
 from utils import length_to_mask
 
+logger = logging.getLogger(__name__)
 
-def convert_to_onnx(model_config, out_dir, model_in, device):
-    text_cleaner = TextCleaner(model_config.symbol)
-    model = ExportModel(**model_in, device=device).eval()
+sample_phonemes = "ðˈiːz wˈɜː tˈuː hˈæv ˈæn ɪnˈɔːɹməs ˈɪmpækt , nˈɑːt ˈoʊnliː bɪkˈɔz ðˈeɪ wˈɜː əsˈoʊsiːˌeɪtᵻd wˈɪð kˈɑːnstəntˌiːn ,"
+
+
+def prepare_export_model(model_class, model_in, device):
+    """Build model_class for export with an ONNX friendly STFT"""
+    model = model_class(**model_in, device=device).eval()
     stft = STFT(
         filter_length=model.generator.gen_istft_n_fft,
         hop_length=model.generator.gen_istft_hop_size,
         win_length=model.generator.gen_istft_n_fft,
     )
     model.generator.stft = stft.to(device).eval()
+    return model
 
-    tokens = (
-        torch.tensor(
-            text_cleaner(
-                "ðˈiːz wˈɜː tˈuː hˈæv ˈæn ɪnˈɔːɹməs ˈɪmpækt , nˈɑːt ˈoʊnliː bɪkˈɔz ðˈeɪ wˈɜː əsˈoʊsiːˌeɪtᵻd wˈɪð kˈɑːnstəntˌiːn ,"
-            )
-        )
-        .unsqueeze(0)
-        .to(device)
+
+def sample_texts(text_cleaner, samples, device):
+    """Right-padded tokens of samples framed by pad tokens, and their lengths"""
+    tokens = [text_cleaner(sample) for sample in samples]
+    texts = torch.zeros([len(tokens), max(len(t) for t in tokens) + 2], dtype=int).to(
+        device
     )
-    texts = torch.zeros([1, tokens.shape[1] + 2], dtype=int).to(device)
-    texts[0, 1 : tokens.shape[1] + 1] = tokens
-    text_lengths = torch.zeros([1], dtype=int).to(device)
-    text_lengths[0] = tokens.shape[1] + 2
-    text_mask = length_to_mask(text_lengths)
+    text_lengths = torch.zeros([len(tokens)], dtype=int).to(device)
+    for i, t in enumerate(tokens):
+        texts[i, 1 : len(t) + 1] = torch.tensor(t)
+        text_lengths[i] = len(t) + 2
+    return texts, text_lengths
 
-    filename = f"{out_dir}/stylish.onnx"
-    inputs = (texts, text_lengths)
+
+def export(model, inputs, filename, input_names, output_names, dynamic_axes):
     with torch.no_grad():
         torch.onnx.export(
             model,
             inputs,
             opset_version=14,
             f=filename,
-            input_names=["texts", "text_lengths"],
-            output_names=["waveform"],
-            dynamic_axes={
-                "texts": {1: "num_token"},
-                "waveform": {0: "num_samples"},
-            },
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
         )
 
+
+def convert_to_onnx(model_config, out_dir, model_in, device):
+    text_cleaner = TextCleaner(model_config.symbol)
+    model = prepare_export_model(ExportModel, model_in, device)
+    texts, text_lengths = sample_texts(text_cleaner, [sample_phonemes], device)
+
+    filename = f"{out_dir}/stylish.onnx"
+    export(
+        model,
+        (texts, text_lengths),
+        filename,
+        input_names=["texts", "text_lengths"],
+        output_names=["waveform"],
+        dynamic_axes={
+            "texts": {1: "num_token"},
+            "waveform": {0: "num_samples"},
+        },
+    )
+
     return filename
+
+
+def convert_to_onnx_batched(model_config, out_dir, model_in, device):
+    text_cleaner = TextCleaner(model_config.symbol)
+    model = prepare_export_model(BatchedExportModel, model_in, device)
+
+    # Lengths differ so that the padding path is traced
+    samples = [sample_phonemes, "həlˈoʊ wˈɜːld ."]
+    texts, text_lengths = sample_texts(text_cleaner, samples, device)
+
+    filename = f"{out_dir}/stylish_batch.onnx"
+    export(
+        model,
+        (texts, text_lengths),
+        filename,
+        input_names=["texts", "text_lengths"],
+        output_names=["waveform", "sample_lengths"],
+        dynamic_axes={
+            "texts": {0: "batch", 1: "num_token"},
+            "text_lengths": {0: "batch"},
+            "waveform": {0: "batch", 1: "num_samples"},
+            "sample_lengths": {0: "batch"},
+        },
+    )
+    check_batched_parity(
+        filename,
+        prepare_export_model(ExportModel, model_in, device),
+        text_cleaner,
+        samples + ["ɪt ɪz ə tˈɛst ."],
+        device,
+    )
+
+    return filename
+
+
+def check_batched_parity(filename, model, text_cleaner, samples, device):
+    """
+    Run the exported batched graph on samples of mixed lengths and compare
+    the valid audio of each item against the single item model. Shorter
+    items are not expected to match exactly: their extra frames are given
+    to the final pad token and still reach the attention in the decoder and
+    generator, so only a large difference is reported as a problem.
+    """
+    texts, text_lengths = sample_texts(text_cleaner, samples, device)
+    session = ort.InferenceSession(filename, providers=["CPUExecutionProvider"])
+    waveforms, sample_lengths = session.run(
+        None,
+        {
+            "texts": texts.cpu().numpy(),
+            "text_lengths": text_lengths.cpu().numpy(),
+        },
+    )
+    for i, sample in enumerate(samples):
+        single_texts, single_lengths = sample_texts(text_cleaner, [sample], device)
+        with torch.no_grad():
+            expected = model(single_texts, single_lengths).cpu().numpy().reshape(-1)
+        actual = waveforms[i, : sample_lengths[i]]
+        length = min(expected.shape[0], actual.shape[0])
+        difference = np.linalg.norm(actual[:length] - expected[:length]) / max(
+            np.linalg.norm(expected[:length]), 1e-8
+        )
+        message = (
+            f"Batched ONNX item {i}: {actual.shape[0]} samples against"
+            + f" {expected.shape[0]} unbatched, relative difference {difference:.4f}"
+        )
+        if actual.shape[0] != expected.shape[0] or difference > 0.1:
+            logger.warning(message)
+        else:
+            logger.info(message)
+
+
+def convert_to_onnx_split(model_config, out_dir, model_in, device):
+    """
+    Export the acoustic front end and the generator as separate graphs so
+    that they can run on different threads. The vocoder takes any number of
+    frames, so long utterances can be vocoded a window at a time.
+    """
+    text_cleaner = TextCleaner(model_config.symbol)
+    model = prepare_export_model(ExportModel, model_in, device)
+    texts, text_lengths = sample_texts(text_cleaner, [sample_phonemes], device)
+
+    front_end_filename = f"{out_dir}/stylish_frontend.onnx"
+    vocoder_filename = f"{out_dir}/stylish_vocoder.onnx"
+    with torch.no_grad():
+        features = model.front_end(texts, text_lengths)
+    export(
+        ExportFrontEnd(model).eval(),
+        (texts, text_lengths),
+        front_end_filename,
+        input_names=["texts", "text_lengths"],
+        output_names=["mel", "style", "pitch", "energy"],
+        dynamic_axes={
+            "texts": {1: "num_token"},
+            "mel": {2: "num_frames"},
+            "style": {2: "num_align_frames"},
+            "pitch": {1: "num_frames"},
+            "energy": {1: "num_frames"},
+        },
+    )
+    export(
+        ExportVocoder(model).eval(),
+        features,
+        vocoder_filename,
+        input_names=["mel", "style", "pitch", "energy"],
+        output_names=["waveform"],
+        dynamic_axes={
+            "mel": {2: "num_frames"},
+            "style": {2: "num_align_frames"},
+            "pitch": {1: "num_frames"},
+            "energy": {1: "num_frames"},
+            "waveform": {0: "num_samples"},
+        },
+    )
+
+    return front_end_filename, vocoder_filename
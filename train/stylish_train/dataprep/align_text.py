@@ -129,11 +129,11 @@ def calculate_alignments(path, wavdir, aligner, model_config, text_cleaner):
         text_lengths = torch.zeros([1], dtype=int, device=device)
         text_lengths[0] = text.shape[1]
 
-        alignment, scores = torch_align(
+        duration, scores = torch_align(
             mels, text, mel_lengths, text_lengths, prediction, model_config
         )
         # alignment = teytaut_align(mels, text, mel_lengths, text_lengths, prediction)
-        alignment_map[name] = alignment
+        alignment_map[name] = duration
         scores_map[name] = scores.exp().mean().item()
     return alignment_map, scores_map
 
@@ -148,8 +148,8 @@ def torch_align(mels, text, mel_length, text_length, prediction, model_config):
         blank=blank,
     )
     alignment = alignment.squeeze()
-    atensor = torch.zeros(
-        [1, text.shape[1], alignment.shape[0]], device=mels.device, dtype=bool
+    token_index = torch.zeros(
+        [alignment.shape[0]], device=mels.device, dtype=torch.long
     )
     text_index = 0
     last_text = alignment[0]
@@ -163,8 +163,11 @@ def torch_align(mels, text, mel_length, text_length, prediction, model_config):
                 last_text = alignment[i]
                 was_blank = False
         assert alignment[i] == blank or alignment[i] == text[0, text_index]
-        atensor[0, text_index, i] = 1
-    return atensor, scores
+        token_index[i] = text_index
+    # Frames per token, which is all the dense alignment encodes since every
+    # frame belongs to exactly one token
+    duration = torch.bincount(token_index, minlength=text.shape[1]).int()
+    return duration.cpu(), scores
 
 
 def teytaut_align(mels, text, mel_length, text_length, prediction):
@@ -0,0 +1,141 @@
+import click
+import json
+import logging
+import os
+from os import path as osp
+
+from safetensors.torch import save_file
+import torch
+import torchaudio
+import tqdm
+
+from stylish_lib.config_loader import load_config_yaml, load_model_config_yaml
+from stylish_train.utils import get_data_path_list
+from stylish_train.meldataset import FeatureShards, load_wave, log_mel, pad_wave
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option("-p", "--config_path", default="configs/new.config.yml", type=str)
+@click.option("-cp", "--model_config_path", default="config/model.config.yml", type=str)
+@click.option("--out", type=str, help="Directory to write the shards and index to")
+@click.option("--shard_mb", default=1024, type=int, help="Approximate size of a shard")
+def main(config_path, model_config_path, out, shard_mb):
+    if osp.exists(config_path):
+        config = load_config_yaml(config_path)
+    else:
+        logger.error(f"Config file not found at {config_path}")
+        exit(1)
+    if osp.exists(model_config_path):
+        model_config = load_model_config_yaml(model_config_path)
+    else:
+        logger.error(f"Config file not found at {model_config_path}")
+        exit(1)
+
+    to_mel = torchaudio.transforms.MelSpectrogram(
+        n_mels=model_config.n_mels,
+        n_fft=model_config.n_fft,
+        win_length=model_config.win_length,
+        hop_length=model_config.hop_length,
+        sample_rate=model_config.sample_rate,
+    )
+    to_align_mel = torchaudio.transforms.MelSpectrogram(
+        n_mels=80,  # align seems to perform worse on higher n_mels
+        n_fft=model_config.n_fft,
+        win_length=model_config.win_length,
+        hop_length=model_config.hop_length,
+        sample_rate=model_config.sample_rate,
+    )
+
+    paths = []
+    for data_path in [config.dataset.val_data, config.dataset.train_data]:
+        for line in get_data_path_list(data_path):
+            paths.append(line.strip().split("|")[0])
+    paths = list(dict.fromkeys(paths))
+
+    os.makedirs(out, exist_ok=True)
+    writer = ShardWriter(out, shard_mb << 20)
+    iterator = tqdm.tqdm(
+        iterable=paths,
+        desc="Writing features",
+        unit="segments",
+        initial=0,
+        colour="MAGENTA",
+        dynamic_ncols=True,
+    )
+    for path in iterator:
+        wave = load_wave(
+            osp.join(config.dataset.wav_path, path), model_config.sample_rate
+        )
+        samples = wave.shape[0]
+        wave = torch.from_numpy(pad_wave(wave, model_config.hop_length)).float()
+        mel = log_mel(to_mel, wave).squeeze(0)
+        align_mel = log_mel(to_align_mel, wave).squeeze(0)
+        writer.add(path, samples, wave, mel, align_mel)
+    writer.flush()
+
+    index = {key: getattr(model_config, key) for key in FeatureShards.config_keys}
+    index["segments"] = writer.segments
+    index_path = osp.join(out, "index.json")
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+    logger.info(f"Wrote {len(paths)} segments to {writer.count} shards in {out}")
+
+
+class ShardWriter:
+    def __init__(self, out, shard_bytes):
+        self.out = out
+        self.shard_bytes = shard_bytes
+        self.segments = {}
+        self.count = 0
+        self.reset()
+
+    def reset(self):
+        self.waves = []
+        self.mels = []
+        self.align_mels = []
+        self.wave_length = 0
+        self.frame_length = 0
+        self.bytes = 0
+
+    def add(self, path, samples, wave, mel, align_mel):
+        self.segments[path] = {
+            "shard": f"shard_{self.count:05d}.safetensors",
+            "samples": samples,
+            "wave": [self.wave_length, wave.shape[0]],
+            "frames": [self.frame_length, mel.shape[1]],
+        }
+        self.waves.append(wave)
+        self.mels.append(mel)
+        self.align_mels.append(align_mel)
+        self.wave_length += wave.shape[0]
+        self.frame_length += mel.shape[1]
+        for tensor in [wave, mel, align_mel]:
+            self.bytes += tensor.numel() * tensor.element_size()
+        if self.bytes >= self.shard_bytes:
+            self.flush()
+
+    def flush(self):
+        if len(self.waves) == 0:
+            return
+        save_file(
+            {
+                "wave": torch.cat(self.waves),
+                "mel": torch.cat(self.mels, dim=1).contiguous(),
+                "align_mel": torch.cat(self.align_mels, dim=1).contiguous(),
+            },
+            osp.join(self.out, f"shard_{self.count:05d}.safetensors"),
+        )
+        self.count += 1
+        self.reset()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ import torchaudio
 from transformers import AutoModel
 import numpy as np
 import k2
+from utils import masked_mean, sequence_mask
 
 
 class SpectralConvergenceLoss(torch.nn.Module):
@@ -16,14 +17,18 @@ class SpectralConvergenceLoss(torch.nn.Module):
         """Initilize spectral convergence loss module."""
         super(SpectralConvergenceLoss, self).__init__()
 
-    def forward(self, x_mag, y_mag):
+    def forward(self, x_mag, y_mag, mask=None):
         """Calculate forward propagation.
         Args:
             x_mag (Tensor): Magnitude spectrogram of predicted signal (B, #frames, #freq_bins).
             y_mag (Tensor): Magnitude spectrogram of groundtruth signal (B, #frames, #freq_bins).
+            mask (Tensor): Optional mask of the frames to compare, broadcast to the spectrograms.
         Returns:
             Tensor: Spectral convergence loss value.
         """
+        if mask is not None:
+            x_mag = x_mag * mask
+            y_mag = y_mag * mask
         return torch.norm(y_mag - x_mag, p=1) / torch.norm(y_mag, p=1)
 
 
@@ -56,11 +61,12 @@ class STFTLoss(torch.nn.Module):
 
         self.spectral_convergence_loss = SpectralConvergenceLoss()
 
-    def forward(self, x, y):
+    def forward(self, x, y, lengths=None):
         """Calculate forward propagation.
         Args:
             x (Tensor): Predicted signal (B, T).
             y (Tensor): Groundtruth signal (B, T).
+            lengths (Tensor): Optional sample count of each signal, the rest is padding.
         Returns:
             Tensor: Spectral convergence loss value.
             Tensor: Log STFT magnitude loss value.
@@ -73,7 +79,11 @@ class STFTLoss(torch.nn.Module):
         mean, std = -4, 4
         y_mag = (torch.log(1e-5 + y_mag) - mean) / std
 
-        sc_loss = self.spectral_convergence_loss(x_mag, y_mag)
+        mask = None
+        if lengths is not None:
+            frames = lengths // self.shift_size + 1
+            mask = sequence_mask(frames, y_mag.shape[-1]).unsqueeze(1)
+        sc_loss = self.spectral_convergence_loss(x_mag, y_mag, mask)
         return sc_loss
 
 
@@ -129,18 +139,19 @@ class MultiResolutionSTFTLoss(torch.nn.Module):
                 )
             ]
 
-    def forward(self, x, y, log):
+    def forward(self, x, y, log, lengths=None):
         """Calculate forward propagation.
         Args:
             x (Tensor): Predicted signal (B, T).
             y (Tensor): Groundtruth signal (B, T).
+            lengths (Tensor): Optional sample count of each signal, the rest is padding.
         Returns:
             Tensor: Multi resolution spectral convergence loss value.
             Tensor: Multi resolution log STFT magnitude loss value.
         """
         sc_loss = 0.0
         for f in self.stft_losses:
-            sc_loss += f(x, y)
+            sc_loss += f(x, y, lengths)
         sc_loss /= len(self.stft_losses)
 
         log.add_loss("mel", sc_loss)
@@ -158,7 +169,7 @@ class MagPhaseLoss(torch.nn.Module):
         self.n_fft = n_fft
         self.hop_length = hop_length
 
-    def forward(self, mag, phase, gt):
+    def forward(self, mag, phase, gt, lengths=None):
         result = 0.0
         if mag is not None and phase is not None:
             y_stft = torch.stft(
@@ -171,8 +182,14 @@ class MagPhaseLoss(torch.nn.Module):
             )
             target_mag = torch.abs(y_stft)
             target_phase = torch.angle(y_stft)
-            mag_loss = torch.nn.functional.l1_loss(mag, target_mag)
-            phase_loss = torch.nn.functional.l1_loss(phase, target_phase)
+            if lengths is None:
+                mag_loss = torch.nn.functional.l1_loss(mag, target_mag)
+                phase_loss = torch.nn.functional.l1_loss(phase, target_phase)
+            else:
+                frames = lengths // self.hop_length + 1
+                mask = sequence_mask(frames, target_mag.shape[-1]).unsqueeze(1)
+                mag_loss = masked_mean(torch.abs(mag - target_mag), mask)
+                phase_loss = masked_mean(torch.abs(phase - target_phase), mask)
             result = mag_loss + phase_loss
         return result
 
@@ -333,8 +350,10 @@ class WavLMLoss(torch.nn.Module):
         super(WavLMLoss, self).__init__()
         self.wavlm = AutoModel.from_pretrained(model)
         self.resample = torchaudio.transforms.Resample(model_sr, slm_sr)
+        self.model_sr = model_sr
+        self.slm_sr = slm_sr
 
-    def forward(self, wav, y_rec):
+    def forward(self, wav, y_rec, lengths=None):
         with torch.no_grad():
             wav_16 = self.resample(wav)
             wav_embeddings = self.wavlm(
@@ -346,7 +365,13 @@ class WavLMLoss(torch.nn.Module):
             input_values=y_rec_16.squeeze(1), output_hidden_states=True
         ).hidden_states
         y_rec_tensor = torch.stack(y_rec_embeddings)
-        return torch.nn.functional.l1_loss(wav_tensor, y_rec_tensor)
+        if lengths is None:
+            return torch.nn.functional.l1_loss(wav_tensor, y_rec_tensor)
+        # WavLM frames are 400 samples at 16kHz with a stride of 320
+        samples = lengths * self.slm_sr // self.model_sr
+        frames = ((samples - 400) // 320 + 1).clamp(min=1)
+        mask = sequence_mask(frames, wav_tensor.shape[2])[None, :, :, None]
+        return masked_mean(torch.abs(wav_tensor - y_rec_tensor), mask)
 
 
 def compute_duration_ce_loss(
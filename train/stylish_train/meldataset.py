@@ -1,4 +1,12 @@
 # coding: utf-8
+import collections
+import json
+import math
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 import os.path as osp
 import numpy as np
 import soundfile as sf
@@ -27,16 +35,11 @@ class FilePathDataset(torch.utils.data.Dataset):
         model_config,
         pitch_path,
         alignment_path,
+        feature_path=None,
+        device_mels=False,
     ):
-        self.pitch = {}
-        with safe_open(pitch_path, framework="pt", device="cpu") as f:
-            for key in f.keys():
-                self.pitch[key] = f.get_tensor(key)
-        self.alignment = {}
-        if osp.isfile(alignment_path):
-            with safe_open(alignment_path, framework="pt", device="cpu") as f:
-                for key in f.keys():
-                    self.alignment[key] = f.get_tensor(key)
+        self.pitch = SafetensorStore(pitch_path)
+        self.duration = SafetensorStore(alignment_path, optional=True)
         self.data_list = []
         sentences = []
         for line in data_list:
@@ -71,21 +74,27 @@ class FilePathDataset(torch.utils.data.Dataset):
         self.sample_rate = model_config.sample_rate
         self.hop_length = model_config.hop_length
 
+        self.features = None
+        if feature_path is not None:
+            self.features = FeatureShards(feature_path, model_config)
+        # Mels are computed by the training loop, so only deliver audio
+        self.device_mels = device_mels
+        # batch_names fields the current stage needs, or None for all
+        self.fields = None
+
+    def wants(self, name):
+        return self.fields is None or name in self.fields
+
     def preprocess(self, wave, align=False):
-        mean, std = -4, 4
-        wave_tensor = wave
         if align:
-            mel_tensor = self.to_align_mel(wave_tensor)
+            return log_mel(self.to_align_mel, wave)
         else:
-            mel_tensor = self.to_mel(wave_tensor)
-        mel_tensor = (torch.log(1e-5 + mel_tensor.unsqueeze(0)) - mean) / std
-        return mel_tensor
+            return log_mel(self.to_mel, wave)
 
     def time_bins(self):
         sample_lengths = []
         total_audio_length = 0
         iterator = tqdm.tqdm(
-            iterable=self.data_list,
             desc="Calculating segment lengths",
             total=len(self.data_list),
             unit="segments",
@@ -94,10 +103,19 @@ class FilePathDataset(torch.utils.data.Dataset):
             colour="MAGENTA",
             dynamic_ncols=True,
         )
-        for data in iterator:
+        scan_paths = []
+        for data in self.data_list:
+            if self.features is None or data[0] not in self.features:
+                scan_paths.append(data[0])
+        headers = scan_audio_headers(self.root_path, scan_paths, iterator)
+        for data in self.data_list:
             wave_path = data[0]
-            wave, sr = sf.read(osp.join(self.root_path, wave_path))
-            wave_len = wave.shape[0]
+            if wave_path not in headers:
+                wave_len = self.features.samples(wave_path)
+                sample_lengths.append(wave_len)
+                total_audio_length += wave_len / self.sample_rate
+                continue
+            wave_len, sr = headers[wave_path]
             if sr != self.sample_rate:
                 wave_len *= self.sample_rate / sr
             sample_lengths.append(wave_len)
@@ -143,10 +161,16 @@ class FilePathDataset(torch.utils.data.Dataset):
         path = data[0]
         wave, text_tensor, speaker_id, mel_tensor, align_mel = self._load_tensor(data)
 
-        acoustic_feature = mel_tensor.squeeze()
-        length_feature = acoustic_feature.size(1)
-        acoustic_feature = acoustic_feature[:, : (length_feature - length_feature % 2)]
-        align_mel = align_mel[:, : (length_feature - length_feature % 2)]
+        acoustic_feature = None
+        if mel_tensor is not None:
+            acoustic_feature = mel_tensor.squeeze()
+            length_feature = acoustic_feature.size(1)
+            acoustic_feature = acoustic_feature[
+                :, : (length_feature - length_feature % 2)
+            ]
+        if align_mel is not None:
+            length_feature = align_mel.size(1)
+            align_mel = align_mel[:, : (length_feature - length_feature % 2)]
 
         # get reference sample
         if self.multispeaker:
@@ -165,17 +189,17 @@ class FilePathDataset(torch.utils.data.Dataset):
         ref_text = torch.LongTensor()
 
         pitch = None
-        if path in self.pitch:
-            pitch = torch.nan_to_num(self.pitch[path].detach().clone())
-        alignment = None
-        if path in self.alignment:
-            alignment = self.alignment[path]
-            alignment = alignment.detach()
-        else:
-            alignment = torch.zeros(
-                (text_tensor.shape[0], align_mel.shape[1] // 2),
-                dtype=torch.float32,  # Match Collater's target dtype
-            )
+        if self.wants("pitch") and path in self.pitch:
+            pitch = torch.nan_to_num(self.pitch[path])
+        duration = None
+        if self.wants("duration") and path in self.duration:
+            duration = self.duration[path]
+            if duration.dim() > 1:
+                # Dense [1, text, frames] alignment from older align_text.py
+                duration = duration.reshape(duration.shape[-2:]).sum(dim=-1)
+            duration = duration.long()
+        elif self.wants("duration"):
+            duration = torch.zeros(text_tensor.shape[0], dtype=torch.long)
 
         return (
             speaker_id,
@@ -188,39 +212,41 @@ class FilePathDataset(torch.utils.data.Dataset):
             wave,
             pitch,
             align_mel,
-            alignment,
+            duration,
         )
 
     def _load_tensor(self, data):
         wave_path, text, speaker_id, _ = data
         speaker_id = int(speaker_id)
-        wave, sr = sf.read(osp.join(self.root_path, wave_path))
-        if wave.shape[-1] == 2:
-            wave = wave[:, 0].squeeze()
-        if sr != self.sample_rate:
-            wave = librosa.resample(wave, orig_sr=sr, target_sr=self.sample_rate)
-            logger.debug(f"{wave_path}, {sr}")
-
-        pad_start = 5000
-        pad_end = 5000
-        time_bin = get_time_bin(wave.shape[0], self.hop_length)
-        if time_bin != -1:
-            frame_count = get_frame_count(time_bin)
-            pad_start = (frame_count * self.hop_length - wave.shape[0]) // 2
-            pad_end = frame_count * self.hop_length - wave.shape[0] - pad_start
-        wave = np.concatenate(
-            [np.zeros([pad_start]), wave, np.zeros([pad_end])], axis=0
-        )
-        wave = torch.from_numpy(wave).float()
+        text = torch.from_numpy(np.pad(self.text_cleaner.encode(text), 1))
 
-        text = self.text_cleaner(text)
+        # With device_mels the training loop needs the audio to make mels
+        need_wave = self.wants("audio_gt") or self.device_mels
+        need_mel = self.wants("mel") and not self.device_mels
+        need_align = self.wants("align_mel") and not self.device_mels
 
-        text.insert(0, 0)
-        text.append(0)
-        text = torch.LongTensor(text)
+        if self.features is not None and wave_path in self.features:
+            wave, mel_tensor, align_mel = self.features.get(
+                wave_path, wave=need_wave, mel=need_mel, align_mel=need_align
+            )
+            return (wave, text, speaker_id, mel_tensor, align_mel)
 
-        mel_tensor = self.preprocess(wave, align=False).squeeze()
-        align_mel = self.preprocess(wave, align=True).squeeze()
+        wave = load_wave(osp.join(self.root_path, wave_path), self.sample_rate)
+        wave = pad_wave(wave, self.hop_length)
+        wave = torch.from_numpy(wave).float()
+
+        mel_tensor = None
+        align_mel = None
+        if need_mel:
+            mel_tensor = self.preprocess(wave, align=False).squeeze()
+        if need_align:
+            if mel_tensor is not None and self.model_config.n_mels == 80:
+                # Both transforms are identical at 80 mels
+                align_mel = mel_tensor
+            else:
+                align_mel = self.preprocess(wave, align=True).squeeze()
+        if not need_wave:
+            wave = None
 
         return (wave, text, speaker_id, mel_tensor, align_mel)
 
@@ -236,47 +262,297 @@ class FilePathDataset(torch.utils.data.Dataset):
         return mel_tensor, speaker_id
 
 
+segment_length_cache = ".segment_lengths.json"
+
+
+def read_audio_header(path):
+    stat = os.stat(path)
+    info = sf.info(path)
+    return stat.st_mtime_ns, stat.st_size, info.frames, info.samplerate
+
+
+def scan_audio_headers(root_path, paths, progress=None):
+    """
+    Frame count and sample rate of each wav under root_path, read from the
+    file headers only. Results are kept in a sidecar cache in root_path
+    keyed by path, mtime and size so only new or changed files are read.
+    Headers are read in a process pool when there are many to read.
+    """
+    cache_path = osp.join(root_path, segment_length_cache)
+    cache = {}
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    result = {}
+    missing = []
+    for path in paths:
+        entry = cache.get(path)
+        if entry is not None:
+            try:
+                stat = os.stat(osp.join(root_path, path))
+                if entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                    result[path] = (entry[2], entry[3])
+                    continue
+            except OSError:
+                pass
+        missing.append(path)
+    if progress is not None:
+        progress.reset(total=len(paths))
+        progress.update(len(result))
+
+    if len(missing) > 0:
+        full_paths = [osp.join(root_path, path) for path in missing]
+        workers = min(32, os.cpu_count() or 1)
+        if len(missing) < 1000 or workers == 1:
+            headers = map(read_audio_header, full_paths)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            headers = executor.map(read_audio_header, full_paths, chunksize=256)
+        try:
+            for path, header in zip(missing, headers):
+                cache[path] = list(header)
+                result[path] = (header[2], header[3])
+                if progress is not None:
+                    progress.update(1)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        # The cache is only an optimization, so a read-only or shared dataset
+        # directory must not stop training
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write segment length cache {cache_path}: {e}")
+    return result
+
+
+def load_wave(path, sample_rate):
+    """Read a wav file as mono at sample_rate"""
+    wave, sr = sf.read(path)
+    if wave.shape[-1] == 2:
+        wave = wave[:, 0].squeeze()
+    if sr != sample_rate:
+        wave = librosa.resample(wave, orig_sr=sr, target_sr=sample_rate)
+        logger.debug(f"{path}, {sr}")
+    return wave
+
+
+def pad_wave(wave, hop_length):
+    """Center wave in silence padded out to the frame count of its time bin"""
+    pad_start = 5000
+    pad_end = 5000
+    time_bin = get_time_bin(wave.shape[0], hop_length)
+    if time_bin != -1:
+        frame_count = get_frame_count(time_bin)
+        pad_start = (frame_count * hop_length - wave.shape[0]) // 2
+        pad_end = frame_count * hop_length - wave.shape[0] - pad_start
+    return np.concatenate([np.zeros([pad_start]), wave, np.zeros([pad_end])], axis=0)
+
+
+def mel_frames(sample_count, hop_length):
+    """Frames kept from the mel of a padded wave, trimmed to an even count"""
+    frames = sample_count // hop_length + 1
+    return frames - frames % 2
+
+
+# Normalized log mel of silence, which pads shorter segments in a batch
+mel_silence = (math.log(1e-5) + 4) / 4
+
+
+def log_mel(to_mel, wave):
+    mean, std = -4, 4
+    mel_tensor = to_mel(wave)
+    mel_tensor = (torch.log(1e-5 + mel_tensor.unsqueeze(0)) - mean) / std
+    return mel_tensor
+
+
+class SafetensorStore:
+    """
+    Read-only mapping over a safetensors file which fetches tensors on
+    demand. The file is memory-mapped, so loader workers share its pages
+    instead of each holding a copy, and opening it only reads the header.
+    If optional is set, a missing file behaves as an empty store.
+    """
+
+    def __init__(self, path, optional=False):
+        self.path = path
+        self.keys = set()
+        self.file = None
+        self.pid = None
+        if not optional or osp.isfile(path):
+            self.keys = set(self.handle().keys())
+
+    def __getstate__(self):
+        # Open handles do not survive pickling into loader workers
+        state = self.__dict__.copy()
+        state["file"] = None
+        state["pid"] = None
+        return state
+
+    def handle(self):
+        if self.pid != os.getpid():
+            self.file = safe_open(self.path, framework="pt", device="cpu")
+            self.pid = os.getpid()
+        return self.file
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, key):
+        return self.handle().get_tensor(key)
+
+
+class FeatureShards:
+    """
+    Read-only view of the feature shards written by
+    dataprep/feature_shards.py. Each shard is a safetensors file holding
+    the padded waves, mels and align mels of many segments concatenated
+    along time. Segments are read as slices of the memory-mapped shard so
+    nothing is decoded or recomputed.
+    """
+
+    # Model config fields which must match between the shards and training
+    config_keys = ["sample_rate", "hop_length", "n_fft", "win_length", "n_mels"]
+
+    def __init__(self, path, model_config):
+        self.path = path
+        with open(osp.join(path, "index.json"), "r") as f:
+            index = json.load(f)
+        for key in self.config_keys:
+            if index[key] != getattr(model_config, key):
+                exit(
+                    f"Feature shards in {path} were made with {key}={index[key]} but the model uses {getattr(model_config, key)}. Run dataprep/feature_shards.py again."
+                )
+        self.segments = index["segments"]
+        self.shards = {}
+        for segment in self.segments.values():
+            if segment["shard"] not in self.shards:
+                self.shards[segment["shard"]] = SafetensorStore(
+                    osp.join(path, segment["shard"])
+                )
+
+    def __contains__(self, path):
+        return path in self.segments
+
+    def samples(self, path):
+        """Length of the segment audio before padding"""
+        return self.segments[path]["samples"]
+
+    def get(self, path, wave=True, mel=True, align_mel=True):
+        """Slices of the segment's features, None for those not asked for"""
+        segment = self.segments[path]
+        f = self.shards[segment["shard"]].handle()
+        wave_start, wave_length = segment["wave"]
+        frame_start, frame_length = segment["frames"]
+        frames = slice(frame_start, frame_start + frame_length)
+        result = [None, None, None]
+        if wave:
+            result[0] = f.get_slice("wave")[wave_start : wave_start + wave_length]
+        if mel:
+            result[1] = f.get_slice("mel")[:, frames]
+        if align_mel:
+            result[2] = f.get_slice("align_mel")[:, frames]
+        return tuple(result)
+
+
 class Collater(object):
     """
     Args:
       adaptive_batch_size (bool): if true, decrease batch size when long data comes.
+      fields (list): batch_names needed by the current stage, or None for all.
+        Other fields which are not needed to schedule the batch are None.
     """
 
-    def __init__(self, return_wave=False, multispeaker=False):
+    # Always collated, they are small and the training loop reads them
+    required_fields = ["text", "text_length", "mel_length", "path"]
+
+    def __init__(
+        self, return_wave=False, multispeaker=False, hop_length=None, fields=None
+    ):
         self.text_pad_index = 0
         self.min_mel_length = 192
         self.max_mel_length = 192
         self.return_wave = return_wave
         self.multispeaker = multispeaker
+        self.hop_length = hop_length
+        self.fields = fields
+
+    def wants(self, name):
+        if name in ["ref_text", "ref_length", "ref_mel"] and not self.multispeaker:
+            return False
+        return (
+            self.fields is None or name in self.fields or name in self.required_fields
+        )
+
+    def mel_length(self, item):
+        if item[1] is not None:
+            return item[1].shape[1]
+        if item[9] is not None:
+            return item[9].shape[1]
+        return mel_frames(item[7].shape[-1], self.hop_length)
 
     def __call__(self, batch):
         batch_size = len(batch)
 
         # sort by mel length
-        lengths = [b[1].shape[1] for b in batch]
+        lengths = [self.mel_length(b) for b in batch]
         batch_indexes = np.argsort(lengths)[::-1]
         batch = [batch[bid] for bid in batch_indexes]
 
-        nmels = batch[0][1].size(0)
-        max_mel_length = max([b[1].shape[1] for b in batch])
+        # Without mels from the dataset they are made on the training device
+        has_mels = batch[0][1] is not None
+        nmels = batch[0][1].size(0) if has_mels else 0
+        has_waves = batch[0][7] is not None
+        has_align_mels = batch[0][9] is not None
+        max_mel_length = max(lengths)
         max_text_length = max([b[2].shape[0] for b in batch])
         max_rtext_length = max([b[3].shape[0] for b in batch])
 
-        labels = torch.zeros((batch_size)).long()
-        mels = torch.zeros((batch_size, nmels, max_mel_length)).float()
-        texts = torch.zeros((batch_size, max_text_length)).long()
-        ref_texts = torch.zeros((batch_size, max_rtext_length)).long()
+        def allocate(name, shape, dtype=torch.float, present=True, fill=0):
+            if not present or not self.wants(name):
+                return None
+            return torch.full(shape, fill, dtype=dtype)
 
+        texts = torch.zeros((batch_size, max_text_length)).long()
         input_lengths = torch.zeros(batch_size).long()
-        ref_lengths = torch.zeros(batch_size).long()
         output_lengths = torch.zeros(batch_size).long()
-        ref_mels = torch.zeros((batch_size, nmels, self.max_mel_length)).float()
-        ref_labels = torch.zeros((batch_size)).long()
         paths = ["" for _ in range(batch_size)]
-        waves = torch.zeros((batch_size, batch[0][7].shape[-1])).float()
-        pitches = torch.zeros((batch_size, max_mel_length)).float()
-        align_mels = torch.zeros((batch_size, 80, max_mel_length)).float()
-        alignments = torch.zeros((batch_size, max_text_length, max_mel_length // 2))
+        waves = None
+        if has_waves and not (has_mels or has_align_mels):
+            # The mels will be made from the audio on the training device
+            waves = torch.zeros((batch_size, batch[0][7].shape[-1])).float()
+        elif has_waves:
+            waves = allocate("audio_gt", (batch_size, batch[0][7].shape[-1]))
+        # Waves and pitch are padded with silence like pad_wave does, and mels
+        # with the log mel of silence
+        mels = allocate(
+            "mel",
+            (batch_size, nmels, max_mel_length),
+            present=has_mels,
+            fill=mel_silence,
+        )
+        ref_texts = allocate("ref_text", (batch_size, max_rtext_length), torch.long)
+        ref_lengths = allocate("ref_length", batch_size, torch.long)
+        ref_mels = allocate("ref_mel", (batch_size, nmels, self.max_mel_length))
+        pitches = allocate("pitch", (batch_size, max_mel_length))
+        align_mels = allocate(
+            "align_mel",
+            (batch_size, 80, max_mel_length),
+            present=has_align_mels,
+            fill=mel_silence,
+        )
+        durations = allocate("duration", (batch_size, max_text_length), torch.long)
 
         for bid, (
             label,
@@ -289,28 +565,32 @@ class Collater(object):
             wave,
             pitch,
             align_mel,
-            alignment,
+            duration,
         ) in enumerate(batch):
-            mel_size = mel.size(1)
+            mel_size = lengths[batch_indexes[bid]]
             text_size = text.size(0)
-            rtext_size = ref_text.size(0)
-            labels[bid] = label
-            mels[bid, :, :mel_size] = mel
             texts[bid, :text_size] = text
-            ref_texts[bid, :rtext_size] = ref_text
             input_lengths[bid] = text_size
-            ref_lengths[bid] = rtext_size
             output_lengths[bid] = mel_size
             paths[bid] = path
-            if self.multispeaker:
+            if waves is not None:
+                # Batches packed from several time bins differ in length
+                waves[bid, : wave.shape[-1]] = wave
+            if mels is not None:
+                mels[bid, :, :mel_size] = mel
+            if align_mels is not None:
+                align_mels[bid, :, :mel_size] = align_mel
+            if ref_texts is not None:
+                rtext_size = ref_text.size(0)
+                ref_texts[bid, :rtext_size] = ref_text
+                ref_lengths[bid] = rtext_size
+            if ref_mels is not None:
                 ref_mel_size = ref_mel.size(1)
                 ref_mels[bid, :, :ref_mel_size] = ref_mel
-                ref_labels[bid] = ref_label
-            waves[bid] = wave
-            if pitch is not None:
-                pitches[bid] = pitch
-            align_mels[bid, :, :mel_size] = align_mel
-            alignments[bid, :text_size, : mel_size // 2] = alignment
+            if pitches is not None and pitch is not None:
+                pitches[bid, : pitch.shape[-1]] = pitch
+            if durations is not None:
+                durations[bid, :text_size] = duration
 
         result = (
             waves,
@@ -324,7 +604,7 @@ class Collater(object):
             paths,
             pitches,
             align_mels,
-            alignments,
+            durations,
         )
         return result
 
@@ -341,10 +621,15 @@ def build_dataloader(
     drop_last=True,
     multispeaker=False,
     epoch=1,
+    fields=None,
+    persistent_workers=False,
     *,
     train,
 ):
     collate_config["multispeaker"] = multispeaker
+    collate_config["hop_length"] = dataset.hop_length
+    collate_config["fields"] = fields
+    dataset.fields = fields
     collate_fn = Collater(**collate_config)
     drop_last = not validation and probe_batch_size is not None
     data_loader = torch.utils.data.DataLoader(
@@ -360,13 +645,219 @@ def build_dataloader(
             train=train,
         ),
         collate_fn=collate_fn,
+        persistent_workers=persistent_workers and num_workers > 0,
+        # DevicePrefetcher pins batches into its own reused buffers
         pin_memory=False,
     )
 
     return data_loader
 
 
+batch_names = [
+    "audio_gt",
+    "text",
+    "text_length",
+    "ref_text",
+    "ref_length",
+    "mel",
+    "mel_length",
+    "ref_mel",
+    "path",
+    "pitch",
+    "align_mel",
+    "duration",
+]
+
+
+class DevicePrefetcher:
+    """
+    Wraps a loader of collated batches so each batch is copied to the device
+    on a side CUDA stream while the previous one is being trained on. Only
+    the batch_names fields in keys are copied, the rest stay on the CPU.
+
+    A background thread copies those fields into pinned buffers which are
+    kept in a pool of up to pool_bytes, keyed by field, shape and dtype.
+    Batches from the fixed time bins repeat the same shapes, so buffers are
+    reused instead of allocated and pinned for every batch. A buffer goes
+    back to the pool once the device copy out of it has finished. The pool
+    lives here rather than in the collater because loader workers hand
+    batches over in shared memory which may still be read. Other devices
+    get the batches unchanged. The time spent waiting for the loader or an
+    unfinished copy is accumulated for logging.
+    """
+
+    def __init__(self, loader, device, keys, pool_bytes=1 << 30, queue_size=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.keys = set(keys)
+        self.stream = None
+        if self.device.type == "cuda" and torch.cuda.is_available():
+            self.stream = torch.cuda.Stream(device=self.device)
+        self.queue_size = queue_size
+        # pool key -> free pinned buffers, least recently used first
+        self.pool = collections.OrderedDict()
+        self.pool_size = 0
+        self.pool_bytes = pool_bytes
+        self.pool_lock = threading.Lock()
+        # (copy event, buffers) of device copies which may still be running
+        self.in_flight = collections.deque()
+        self.wait_time = 0.0
+        self.wait_count = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.stream is None:
+            batches = iter(self.loader)
+        else:
+            batches = self.pinned_batches()
+        try:
+            start = time.perf_counter()
+            upcoming = self.preload(batches)
+            while upcoming is not None:
+                batch, copied = upcoming
+                if copied is not None:
+                    copied.synchronize()
+                    # The memory was allocated on the side stream but is used
+                    # on the compute stream, so keep it from being reused too
+                    # early
+                    current = torch.cuda.current_stream(self.device)
+                    for item in batch:
+                        if isinstance(item, torch.Tensor) and item.is_cuda:
+                            item.record_stream(current)
+                upcoming = self.preload(batches)
+                self.wait_time += time.perf_counter() - start
+                self.wait_count += 1
+                yield batch
+                start = time.perf_counter()
+        finally:
+            if self.stream is not None:
+                # Stops the pinning thread when the loop is left early
+                batches.close()
+
+    def pinned_batches(self):
+        """
+        Yield (batch, buffers) from the loader with the copied fields in
+        pooled pinned buffers, which are filled on a background thread.
+        buffers holds the (pool key, buffer) pairs the batch uses.
+        """
+        pinned = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if stop.is_set():
+                        return
+                    pinned.put(self.pin(batch))
+            except Exception as e:
+                pinned.put(e)
+            finally:
+                pinned.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = pinned.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            # Unblock the producer if it is waiting on a full queue, and
+            # return the buffers of batches which were never copied
+            while producer.is_alive() or not pinned.empty():
+                try:
+                    item = pinned.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if isinstance(item, tuple):
+                    with self.pool_lock:
+                        self.recycle(item[1])
+
+    def pin(self, batch):
+        batch = list(batch)
+        buffers = []
+        for i, key in enumerate(batch_names):
+            if key in self.keys and isinstance(batch[i], torch.Tensor):
+                pool_key = (key, tuple(batch[i].shape), batch[i].dtype)
+                buffer = self.acquire(pool_key, batch[i])
+                buffer.copy_(batch[i])
+                buffers.append((pool_key, buffer))
+                batch[i] = buffer
+        return batch, buffers
+
+    def acquire(self, pool_key, tensor):
+        with self.pool_lock:
+            free = self.pool.get(pool_key)
+            if free is not None:
+                buffer = free.pop()
+                if len(free) == 0:
+                    del self.pool[pool_key]
+                return buffer
+            self.pool_size += tensor.nbytes
+        return torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+
+    def release(self):
+        """Return the buffers of finished device copies to the pool"""
+        with self.pool_lock:
+            while len(self.in_flight) > 0 and self.in_flight[0][0].query():
+                _, buffers = self.in_flight.popleft()
+                self.recycle(buffers)
+            while self.pool_size > self.pool_bytes and len(self.pool) > 0:
+                pool_key, free = next(iter(self.pool.items()))
+                self.pool_size -= free.pop().nbytes
+                if len(free) == 0:
+                    del self.pool[pool_key]
+
+    def recycle(self, buffers):
+        for pool_key, buffer in buffers:
+            self.pool.setdefault(pool_key, []).append(buffer)
+            self.pool.move_to_end(pool_key)
+
+    def preload(self, batches):
+        item = next(batches, None)
+        if item is None or self.stream is None:
+            return None if item is None else (item, None)
+        batch, buffers = item
+        with torch.cuda.stream(self.stream):
+            for i, key in enumerate(batch_names):
+                if key in self.keys and isinstance(batch[i], torch.Tensor):
+                    batch[i] = batch[i].to(self.device, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        self.in_flight.append((copied, buffers))
+        self.release()
+        return batch, copied
+
+    def take_wait_time(self):
+        """Average seconds per batch spent waiting on input since the last call"""
+        result = self.wait_time / max(self.wait_count, 1)
+        self.wait_time = 0.0
+        self.wait_count = 0
+        return result
+
+
 class DynamicBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields batches of dataset indices which each come from a single time
+    bin. The whole epoch is planned up front from the seed and epoch: every
+    bin is shuffled and cut into batches of the stage's batch size for that
+    bin, then the batches of all bins are shuffled together. When the
+    stage's batch sizes change during the epoch, the batches not yet yielded
+    are planned again with the new sizes. Setting start_batch makes the next
+    iteration begin at that batch of the plan, so resuming mid epoch does
+    not load the batches before it.
+
+    If the stage has a frame_budget, neighbouring bins are merged by
+    budget_groups and batched together instead. The padding this costs is
+    tracked for each epoch and returned by take_padding_report.
+    """
+
     def __init__(
         self,
         time_bins,
@@ -385,8 +876,12 @@ class DynamicBatchSampler(torch.utils.data.Sampler):
         self.drop_last = drop_last
 
         self.epoch = epoch
-        self.total_len = 0
-        self.last_bin = None
+        self.start_batch = 0
+        self.revision = None
+        self.bin_lookup = None
+        self.padded_frames = 0
+        self.segment_frames = 0
+        self.batches = 0
 
         self.force_bin = force_bin
         self.force_batch_size = force_batch_size
@@ -395,69 +890,117 @@ class DynamicBatchSampler(torch.utils.data.Sampler):
         self.train = train
 
     def __iter__(self):
-        samples = {}
         g = torch.Generator()
         g.manual_seed(self.seed + self.epoch)
+        if self.force_batch_size is None:
+            self.train.stage.load_batch_sizes()
+        batches = self.plan(self.bin_samples(g), g)
+        bin_lookup = self.get_bin_lookup()
+        position = self.start_batch
+        self.start_batch = 0
+        while position < len(batches):
+            if self.revision != self.batch_size_revision():
+                remaining = np.concatenate([batch for _, batch in batches[position:]])
+                remaining_bins = bin_lookup[remaining]
+                samples = {}
+                for key in np.unique(remaining_bins).tolist():
+                    samples[key] = remaining[remaining_bins == key]
+                batches = self.plan(samples, g)
+                position = 0
+                continue
+            _, batch = batches[position]
+            position += 1
+            frames = get_frame_count(bin_lookup[batch])
+            self.padded_frames += len(batch) * int(frames.max())
+            self.segment_frames += int(frames.sum())
+            self.batches += 1
+            yield batch.tolist()
+
+    def get_bin_lookup(self):
+        """Array of the time bin of each dataset index"""
+        if self.bin_lookup is None:
+            size = 1 + max([max(v) for v in self.time_bins.values() if len(v) > 0])
+            self.bin_lookup = np.full(size, -1, dtype=np.int64)
+            for key, indices in self.time_bins.items():
+                self.bin_lookup[np.asarray(indices, dtype=np.int64)] = key
+        return self.bin_lookup
+
+    def bin_samples(self, g):
+        """Dataset indices of each bin in the order they will be batched"""
+        samples = {}
+        keys = sorted(self.time_bins.keys())
         if self.force_bin is not None:
-            samples = {self.force_bin: self.time_bins[self.force_bin]}
-        else:
-            for key in self.time_bins.keys():
-                if self.get_batch_size(key) <= 0:
-                    continue
-                if not self.drop_last or len(
-                    self.time_bins[key] >= self.get_batch_size(key)
-                ):
-                    if self.shuffle:
-                        order = torch.randperm(len(self.time_bins[key]), generator=g)
-                        current = []
-                        for index in order:
-                            current.append(self.time_bins[key][index])
-                        samples[key] = current
-                    else:
-                        samples[key] = self.time_bins[key]
-
-        sample_keys = list(samples.keys())
-        while len(sample_keys) > 0:
-            index = 0
+            keys = [self.force_bin]
+        for key in keys:
+            indices = np.asarray(self.time_bins[key], dtype=np.int64)
             if self.shuffle:
-                total_weight = 0
-                for key in sample_keys:
-                    total_weight += len(samples[key]) // self.get_batch_size(key) + 1
-                weight = torch.randint(0, total_weight, [1], generator=g)[0]
-                for i in range(len(sample_keys)):
-                    weight -= (
-                        len(samples[sample_keys[i]])
-                        // self.get_batch_size(sample_keys[i])
-                        + 1
-                    )
-                    if weight <= 0:
-                        index = i
-                        break
-            key = sample_keys[index]
-            current_samples = samples[key]
-            batch_size = min(len(current_samples), self.get_batch_size(key))
-            batch = current_samples[:batch_size]
-            remaining = current_samples[batch_size:]
-            if len(remaining) == 0 or (self.drop_last and len(remaining) < batch_size):
-                del samples[key]
-            else:
-                samples[key] = remaining
-            yield batch
-            self.train.stage.load_batch_sizes()
-            sample_keys = list(samples.keys())
+                indices = indices[torch.randperm(len(indices), generator=g).numpy()]
+            samples[key] = indices
+        return samples
+
+    def plan(self, samples, g):
+        """List of (bin, indices) batches in the order they will be yielded"""
+        self.revision = self.batch_size_revision()
+        batches = []
+        for bins, batch_size in self.groups(samples.keys()):
+            indices = np.concatenate([samples[key] for key in bins])
+            if self.shuffle and len(bins) > 1:
+                indices = indices[torch.randperm(len(indices), generator=g).numpy()]
+            count = self.batch_count(len(indices), batch_size)
+            for i in range(count):
+                batches.append((bins, indices[i * batch_size : (i + 1) * batch_size]))
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=g).tolist()
+            batches = [batches[i] for i in order]
+        return batches
+
+    def groups(self, keys):
+        """List of (bins, batch size) for the bins which are batched together"""
+        if self.force_batch_size is None and self.train.stage.frame_budget is not None:
+            return budget_groups(
+                keys, self.train.stage.frame_budget, self.train.stage.max_padding
+            )
+        return [([key], self.get_batch_size(key)) for key in sorted(keys)]
+
+    def batch_count(self, sample_count, batch_size):
+        if batch_size <= 0:
+            return 0
+        if self.drop_last:
+            return sample_count // batch_size
+        return math.ceil(sample_count / batch_size)
+
+    def batch_size_revision(self):
+        if self.force_batch_size is not None:
+            return None
+        return self.train.stage.batch_size_revision
 
     def __len__(self):
-        return self.train.stage.get_steps_per_epoch()
+        keys = self.time_bins.keys()
+        if self.force_bin is not None:
+            keys = [self.force_bin]
         total = 0
-        for key in self.time_bins.keys():
-            val = self.time_bins[key]
-            total_batch = self.train.stage.get_batch_size(key)
-            if total_batch > 0:
-                total += len(val) // total_batch
-                if not self.drop_last and len(val) % total_batch != 0:
-                    total += 1
+        for bins, batch_size in self.groups(keys):
+            sample_count = sum([len(self.time_bins[key]) for key in bins])
+            total += self.batch_count(sample_count, batch_size)
         return total
 
+    def take_padding_report(self):
+        """
+        Batches yielded since the last call, their average padded frames and
+        the fraction of those which pad segments to the longest in the batch
+        """
+        result = (0, 0.0, 0.0)
+        if self.batches > 0:
+            result = (
+                self.batches,
+                self.padded_frames / self.batches,
+                1 - self.segment_frames / self.padded_frames,
+            )
+        self.padded_frames = 0
+        self.segment_frames = 0
+        self.batches = 0
+        return result
+
     def set_epoch(self, epoch):
         self.epoch = epoch
 
@@ -475,6 +1018,27 @@ class DynamicBatchSampler(torch.utils.data.Sampler):
             return self.train.stage.get_batch_size(key)
 
 
+def budget_groups(keys, frame_budget, max_padding):
+    """
+    Merge neighbouring time bins so that no segment in a group has more
+    than max_padding of its frames padded out to the longest bin. Each
+    group gets the batch size which fits its longest bin in frame_budget,
+    which is 0 for bins too long for the budget.
+    """
+    groups = []
+    current = []
+    for key in sorted(keys):
+        if len(current) > 0 and get_frame_count(current[0]) < (
+            1 - max_padding
+        ) * get_frame_count(key):
+            groups.append(current)
+            current = []
+        current.append(key)
+    if len(current) > 0:
+        groups.append(current)
+    return [(group, frame_budget // get_frame_count(group[-1])) for group in groups]
+
+
 def get_frame_count(i):
     return i * 20 + 20 + 40
 
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 from .common import LinearNorm
+from utils import sequence_mask
 
 
 # class DurationPredictor(nn.Module):
@@ -160,6 +161,46 @@ class DurationEncoder(nn.Module):
 
         return rearrange(x, "b c t -> b t c")
 
+    def infer_batch(self, x, style, text_lengths):
+        """
+        Padded batch variant of infer. Padding is masked out and the LSTMs
+        only run over the first text_lengths tokens of each item.
+        x: (batch, channels, tokens)
+        style: (batch, embedding, tokens)
+        text_lengths: (batch)
+        """
+        mask = sequence_mask(text_lengths, x.shape[2]).unsqueeze(1)
+        x = torch.cat([x, style], dim=1) * mask
+
+        for block in self.lstms:
+            if isinstance(block, AdaLayerNorm):
+                x = rearrange(x, "b c t -> b t c")
+                x = block(x, style)
+                x = rearrange(x, "b t c -> b c t")
+                x = torch.cat([x, style], dim=1) * mask
+            else:
+                x = rearrange(x, "b c t -> b t c")
+                x = packed_lstm(block, x, text_lengths)
+                x = rearrange(x, "b t c -> b c t")
+
+        return rearrange(x, "b c t -> b t c")
+
+
+def packed_lstm(lstm, x, lengths):
+    """
+    Run a batch_first LSTM over right-padded x so that the reverse direction
+    of bidirectional LSTMs starts at the last real step of each item.
+    """
+    total_length = x.shape[1]
+    x = nn.utils.rnn.pack_padded_sequence(
+        x, lengths.cpu(), batch_first=True, enforce_sorted=False
+    )
+    x, _ = lstm(x)
+    x, _ = nn.utils.rnn.pad_packed_sequence(
+        x, batch_first=True, total_length=total_length
+    )
+    return x
+
 
 class AdaLayerNorm(nn.Module):
     def __init__(self, style_dim, channels, eps=1e-5):
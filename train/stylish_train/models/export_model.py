@@ -1,5 +1,8 @@
 import torch
 
+from utils import duration_to_alignment, sequence_mask
+from .duration_predictor import packed_lstm
+
 
 class ExportModel(torch.nn.Module):
     def __init__(
@@ -50,12 +53,17 @@ class ExportModel(torch.nn.Module):
         energy,
         style,
     ):
+        mel, style = self.decode(text_encoding, duration, pitch, energy, style)
+        prediction = self.generator(mel=mel, style=style, pitch=pitch, energy=energy)
+        return prediction
+
+    def decode(self, text_encoding, duration, pitch, energy, style):
+        """Decoder features and frame-level style for the generator"""
         style = style @ duration
         mel, _ = self.decoder(
             text_encoding @ duration, pitch, energy, style, probing=False
         )
-        prediction = self.generator(mel=mel, style=style, pitch=pitch, energy=energy)
-        return prediction
+        return mel, style
 
     def duration_predict(self, duration_encoding, prosody_embedding):
         d = self.duration_predictor.text_encoder.infer(
@@ -78,7 +86,11 @@ class ExportModel(torch.nn.Module):
         prosody = d.permute(0, 2, 1) @ pred_aln_trg
         return pred_aln_trg, prosody
 
-    def forward(self, texts, text_lengths):
+    def front_end(self, texts, text_lengths):
+        """
+        Everything up to the generator. Returns the decoder features and the
+        frame-level style, pitch and energy which the generator consumes.
+        """
         text_encoding, _, _ = self.text_encoder(texts, text_lengths)
         duration_encoding, _, _ = self.text_duration_encoder(texts, text_lengths)
         style_embedding = self.textual_style_encoder(text_encoding)
@@ -91,11 +103,105 @@ class ExportModel(torch.nn.Module):
         pitch_prediction, energy_prediction = self.pitch_energy_predictor(
             prosody, prosody_embedding
         )
-        prediction = self.decoding_single(
+        mel, style = self.decode(
             text_encoding,
             duration_prediction,
             pitch_prediction,
             energy_prediction,
             style_embedding,
         )
+        return mel, style, pitch_prediction, energy_prediction
+
+    def vocode(self, mel, style, pitch, energy):
+        prediction = self.generator(mel=mel, style=style, pitch=pitch, energy=energy)
         return prediction.audio.squeeze()
+
+    def forward(self, texts, text_lengths):
+        return self.vocode(*self.front_end(texts, text_lengths))
+
+
+class ExportFrontEnd(torch.nn.Module):
+    """ONNX export wrapper for ExportModel.front_end"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, texts, text_lengths):
+        return self.model.front_end(texts, text_lengths)
+
+
+class ExportVocoder(torch.nn.Module):
+    """ONNX export wrapper for ExportModel.vocode"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, mel, style, pitch, energy):
+        return self.model.vocode(mel, style, pitch, energy)
+
+
+class BatchedExportModel(ExportModel):
+    """
+    Variant of ExportModel which synthesizes a batch of right-padded phoneme
+    sequences in one call. Returns the padded waveforms and the number of
+    valid samples for each item.
+
+    Text lengths are a true mask up to the durations: padding tokens are
+    masked and the LSTMs stop at each item's last token. After that every
+    item is stretched to the longest by giving its extra frames to its
+    final pad token. Those frames are still attended to by the decoder and
+    generator, so a shorter item is close to, but not exactly, what the
+    single item model gives. convert_to_onnx_batched reports how close.
+    """
+
+    def duration_predict(self, duration_encoding, prosody_embedding, text_lengths):
+        text_mask = sequence_mask(text_lengths, duration_encoding.shape[2])
+        d = self.duration_predictor.text_encoder.infer_batch(
+            duration_encoding, prosody_embedding, text_lengths
+        )
+        x = packed_lstm(self.duration_predictor.lstm, d, text_lengths)
+        duration = self.duration_predictor.duration_proj(x)
+        duration = torch.sigmoid(duration).sum(axis=-1)
+        pred_dur = torch.round(duration).clamp(min=1).long() * text_mask
+
+        # Every item is stretched to the longest item by giving the extra
+        # frames to its final (padding) token, so the tail is silence
+        frame_lengths = pred_dur.sum(dim=-1)
+        last_token = torch.nn.functional.one_hot(
+            text_lengths - 1, num_classes=pred_dur.shape[1]
+        )
+        pred_dur = (
+            pred_dur + last_token * (frame_lengths.max() - frame_lengths)[:, None]
+        )
+
+        pred_aln_trg = duration_to_alignment(pred_dur, frame_lengths.max())
+
+        prosody = d.permute(0, 2, 1) @ pred_aln_trg
+        return pred_aln_trg, prosody, frame_lengths
+
+    def forward(self, texts, text_lengths):
+        text_encoding, _, _ = self.text_encoder(texts, text_lengths)
+        duration_encoding, _, _ = self.text_duration_encoder(texts, text_lengths)
+        style_embedding = self.textual_style_encoder(text_encoding)
+        prosody_embedding = self.textual_prosody_encoder(duration_encoding)
+        duration_prediction, prosody, frame_lengths = self.duration_predict(
+            duration_encoding,
+            prosody_embedding,
+            text_lengths,
+        )
+        prosody_embedding = prosody_embedding @ duration_prediction
+        pitch_prediction, energy_prediction = self.pitch_energy_predictor(
+            prosody, prosody_embedding
+        )
+        prediction = self.decoding_single(
+            text_encoding,
+            duration_prediction,
+            pitch_prediction,
+            energy_prediction,
+            style_embedding,
+        )
+        audio = prediction.audio.reshape(texts.shape[0], -1)
+        samples_per_frame = audio.shape[1] // duration_prediction.shape[2]
+        return audio, frame_lengths * samples_per_frame
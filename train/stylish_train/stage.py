@@ -1,3 +1,4 @@
+import contextlib
 import json
 import math
 import os
@@ -9,7 +10,16 @@ from munch import Munch
 import tqdm
 import matplotlib.pyplot as plt
 
+from batch_sizes import BatchProfileStore
 from loss_log import combine_logs
+from meldataset import (
+    DevicePrefetcher,
+    batch_names,
+    budget_groups,
+    log_mel,
+    mel_frames,
+    mel_silence,
+)
 from stage_train import (
     train_alignment,
     train_acoustic,
@@ -24,6 +34,7 @@ from stage_validate import (
 
 from optimizers import build_optimizer
 from utils import (
+    sequence_mask,
     get_image,
     plot_spectrogram_to_figure,
     plot_mel_signed_difference_to_figure,
@@ -84,7 +95,7 @@ stages = {
             "mel_length",
             "audio_gt",
             "pitch",
-            "alignment",
+            "duration",
         ],
     ),
     "textual": StageConfig(
@@ -111,7 +122,7 @@ stages = {
             "mel_length",
             "audio_gt",
             "pitch",
-            "alignment",
+            "duration",
         ],
     ),
 }
@@ -135,8 +146,21 @@ class Stage:
         self.val_time_bins: dict = val_time_bins
 
         self.batch_sizes: Dict[str, int] = {}
+        # Incremented on every change so samplers know to replan
+        self.batch_size_revision: int = 0
+        self.frame_budget: Optional[int] = None
+        self.max_padding: float = 0.0
+        self.load_frame_budget(train)
         self.last_batch_load = None
         self.out_dir = train.out_dir
+        self.profiles: Optional[BatchProfileStore] = None
+        if train.config.training.batch_profile_path is not None:
+            self.profiles = BatchProfileStore(train.config.training.batch_profile_path)
+        self.profile_key: Optional[dict] = None
+        # Total loss of the latest validation not yet given to a checkpoint,
+        # used to pick the best checkpoint
+        self.val_loss: Optional[float] = None
+        self.set_profile_key(train)
         self.load_batch_sizes()
         train.manifest.steps_per_epoch = self.get_steps_per_epoch()
 
@@ -144,23 +168,58 @@ class Stage:
         self.validate_fn: Callable = stages[name].validate_fn
         self.optimizer = build_optimizer(self.name, train=train)
         self.optimizer.prepare(train.accelerator)
+        # Gradients are summed over batches until accumulate_seconds of audio
+        self.accumulate_seconds: Optional[float] = None
+        self.accumulated_seconds: float = 0.0
+        self.accumulated_samples: int = 0
+        self.load_accumulation(train)
+        self.model: Optional[Munch] = None
+        self.place_models(train)
 
     def begin_stage(self, name, train):
         self.name = name
         self.max_epoch = train.config.training_plan.get_stage(name).epochs
+        self.load_frame_budget(train)
         self.train_fn = stages[name].train_fn
         self.validate_fn = stages[name].validate_fn
         self.optimizer.reset_lr(name, train)
+        self.load_accumulation(train)
         train.reset_out_dir(name)
         self.last_batch_load = None
         self.out_dir = train.out_dir
+        self.set_profile_key(train)
         self.load_batch_sizes()
+        self.place_models(train)
+
+    def place_models(self, train) -> None:
+        """
+        Move the models the stage uses to the device and the others to the
+        cpu. This only changes between stages, so it is done once here.
+        """
+        config = stages[self.name]
+        train.checkpoint_writer.forget()
+        self.model = prepare_model(
+            train.model,
+            train.config.training.device,
+            config.train_models,
+            config.eval_models,
+            config.discriminators,
+            train,
+        )
+
+    def device_inputs(self, train) -> List[str]:
+        """Batch fields the current stage needs on the device"""
+        inputs = stages[self.name].inputs
+        if train.config.training.device_mels and "audio_gt" not in inputs:
+            inputs = inputs + ["audio_gt"]
+        return inputs
 
     def get_next_stage(self) -> Optional[str]:
         return stages[self.name].next_stage
 
     def set_batch_size(self, i: int, batch_size: int) -> None:
         self.batch_sizes[str(i)] = batch_size
+        self.batch_size_revision += 1
 
     def get_batch_size(self, key: int) -> int:
         if str(key) in self.batch_sizes:
@@ -168,12 +227,51 @@ class Stage:
         else:
             return 1
 
+    def load_frame_budget(self, train) -> None:
+        stage_config = train.config.training_plan.get_stage(self.name)
+        self.frame_budget = stage_config.frame_budget
+        self.max_padding = stage_config.max_padding
+        self.batch_size_revision += 1
+
+    def load_accumulation(self, train) -> None:
+        stage_config = train.config.training_plan.get_stage(self.name)
+        self.accumulate_seconds = stage_config.accumulate_seconds
+        self.reset_accumulation()
+
+    def take_val_loss(self) -> Optional[float]:
+        """Validation loss since the last call, or None if none has finished"""
+        result, self.val_loss = self.val_loss, None
+        return result
+
+    def reset_accumulation(self) -> None:
+        """Drop the gradients accumulated since the last optimizer step"""
+        self.optimizer.zero_grad()
+        self.accumulated_seconds = 0.0
+        self.accumulated_samples = 0
+
+    def set_frame_budget(self, frame_budget: int) -> None:
+        self.frame_budget = frame_budget
+        self.batch_size_revision += 1
+
     def reset_batch_sizes(self) -> None:
         self.batch_sizes = {}
+        self.batch_size_revision += 1
 
     def batch_sizes_exist(self):
         return self.last_batch_load is not None
 
+    def set_profile_key(self, train) -> None:
+        if self.profiles is not None:
+            self.profile_key = self.profiles.key(
+                device=train.config.training.device,
+                model_config=train.model_config,
+                stage=self.name,
+                mixed_precision=train.config.training.mixed_precision,
+                probe_batch_max=train.config.training_plan.get_stage(
+                    self.name
+                ).probe_batch_max,
+            )
+
     def load_batch_sizes(self) -> None:
         batch_file = osp.join(self.out_dir, f"{self.name}_batch_sizes.json")
         if osp.isfile(batch_file):
@@ -182,11 +280,28 @@ class Stage:
                 with open(batch_file, "r") as batch_input:
                     self.batch_sizes = json.load(batch_input)
                     self.last_batch_load = modified
+                    self.batch_size_revision += 1
+        elif self.last_batch_load is None and self.profiles is not None:
+            batch_sizes = self.profiles.get(self.profile_key)
+            # A profile from a dataset without some of these time bins would
+            # leave them unprobed at a batch size of 1
+            if batch_sizes is not None and all(
+                str(key) in batch_sizes for key in self.train_time_bins.keys()
+            ):
+                self.batch_sizes = batch_sizes
+                # Counts as loaded, and a file saved later is always newer
+                self.last_batch_load = 0.0
+                self.batch_size_revision += 1
 
     def save_batch_sizes(self) -> None:
         batch_file = osp.join(self.out_dir, f"{self.name}_batch_sizes.json")
         with open(batch_file, "w") as o:
             json.dump(self.batch_sizes, o)
+        # The sizes in memory are what was just written, so load_batch_sizes
+        # must not read them back over later changes
+        self.last_batch_load = os.stat(batch_file).st_mtime
+        if self.profiles is not None:
+            self.profiles.put(self.profile_key, self.batch_sizes)
 
     def get_steps_per_val(self) -> int:
         return self.get_steps(self.val_time_bins)
@@ -195,37 +310,90 @@ class Stage:
         return self.get_steps(self.train_time_bins)
 
     def get_steps(self, time_bins):
+        if self.frame_budget is not None:
+            groups = budget_groups(
+                time_bins.keys(), self.frame_budget, self.max_padding
+            )
+        else:
+            groups = [([key], self.get_batch_size(key)) for key in time_bins.keys()]
         total = 0
-        for key in time_bins.keys():
-            val = time_bins[key]
-            total_batch = self.get_batch_size(key)
+        for bins, total_batch in groups:
             if total_batch > 0:
-                total += len(val) // total_batch + 1
+                total += math.ceil(sum([len(time_bins[k]) for k in bins]) / total_batch)
         return total
 
     def train_batch(self, inputs, train, probing=False):
+        """
+        Runs one batch and returns its losses and whether the optimizers
+        stepped, which they only do once accumulate_seconds of audio has
+        been summed over batches.
+        """
         config = stages[self.name]
         batch = prepare_batch(inputs, train.config.training.device, config.inputs)
-        model = prepare_model(
-            train.model,
-            train.config.training.device,
-            config.train_models,
-            config.eval_models,
-            config.discriminators,
-            train,
+        if train.config.training.device_mels:
+            compute_mels(batch, inputs, config.inputs, train)
+        batch_size = batch.text.shape[0]
+        samples = batch_size
+        seconds = (
+            float(inputs[6].max() * batch_size * train.model_config.hop_length)
+            / train.model_config.sample_rate
+        )
+        if train.accelerator.num_processes > 1:
+            # Every process has to make the same step decision, or some
+            # would reduce gradients while others wait in no_sync
+            totals = train.accelerator.reduce(
+                torch.tensor(
+                    [samples, seconds],
+                    dtype=torch.float64,
+                    device=train.accelerator.device,
+                ),
+                reduction="sum",
+            ).tolist()
+            samples, seconds = round(totals[0]), totals[1]
+        self.accumulated_samples += samples
+        self.accumulated_seconds += seconds
+        step = (
+            probing
+            or self.accumulate_seconds is None
+            or self.accumulated_seconds >= self.accumulate_seconds
         )
-        result, audio = self.train_fn(batch, model, train, probing)
-        optimizer_step(self.optimizer, config.train_models)
+        # Gradients only need to be reduced across processes on the
+        # backward which steps; the discriminator gradients from the
+        # generator losses are dropped, so those are never reduced.
+        train_sync_keys = [] if step else config.train_models
+        # The generator losses also reach the discriminators, so set their
+        # accumulated gradients aside and drop what the generator adds
+        discriminator_grads = take_grads(self.model, config.discriminators)
+        with no_sync(
+            train.accelerator, self.model, train_sync_keys + config.discriminators
+        ):
+            result, audio = self.train_fn(batch, self.model, train, probing)
+        restore_grads(self.model, config.discriminators, discriminator_grads)
+        # Losses are scaled by the batch size on backward. Scaling the sum by
+        # 1/sqrt(samples) gives every step the sqrt(batch size) weight of a
+        # single batch holding all of them. Samples are counted over every
+        # process while DDP averages the gradients, so the count is per
+        # process.
+        scale = math.sqrt(train.accelerator.num_processes / self.accumulated_samples)
+        if step:
+            scale_grads(self.model, config.train_models, scale)
+            optimizer_step(self.optimizer, config.train_models)
         if len(config.discriminators) > 0:
             audio_gt = batch.audio_gt.unsqueeze(1)
             audio = audio.detach()
-            train.stage.optimizer.zero_grad()
-            d_loss = train.discriminator_loss(audio_gt, audio, config.discriminators)
-            train.accelerator.backward(d_loss * math.sqrt(batch.text.shape[0]))
-            optimizer_step(self.optimizer, config.discriminators)
-            train.stage.optimizer.zero_grad()
+            discriminator_sync_keys = [] if step else config.discriminators
+            with no_sync(train.accelerator, self.model, discriminator_sync_keys):
+                d_loss = train.discriminator_loss(
+                    audio_gt, audio, config.discriminators
+                )
+                train.accelerator.backward(d_loss * batch_size)
+            if step:
+                scale_grads(self.model, config.discriminators, scale)
+                optimizer_step(self.optimizer, config.discriminators)
             result.add_loss("discriminator", d_loss)
-        return result.detach()
+        if step:
+            self.reset_accumulation()
+        return result.detach(), step
 
     def validate(self, train):
         sample_count = train.config.validation.sample_count
@@ -233,9 +401,14 @@ class Stage:
             train.model[key].eval()
         logs = []
         progress_bar = None
+        loader = DevicePrefetcher(
+            train.val_dataloader,
+            train.config.training.device,
+            self.device_inputs(train),
+        )
         if train.accelerator.is_main_process:
             iterator = tqdm.tqdm(
-                iterable=enumerate(train.val_dataloader),
+                iterable=enumerate(loader),
                 desc=f"Validating {self.name}",
                 total=self.get_steps_per_val(),
                 unit="steps",
@@ -247,7 +420,7 @@ class Stage:
             )
             progress_bar = iterator
         else:
-            iterator = enumerate(train.val_dataloader)
+            iterator = enumerate(loader)
 
         sample_map = {
             item: j for j, item in enumerate(train.config.validation.force_samples)
@@ -257,6 +430,8 @@ class Stage:
                 batch = prepare_batch(
                     inputs, train.config.training.device, stages[self.name].inputs
                 )
+                if train.config.training.device_mels:
+                    compute_mels(batch, inputs, stages[self.name].inputs, train)
                 next_log, attention, audio_out, audio_gt = self.validate_fn(
                     batch, train
                 )
@@ -299,11 +474,9 @@ class Stage:
                                 sample_rate=sample_rate,
                             )
                             # write mel
-                            audio_pred_cpu = (
-                                audio_out[inputs_index].squeeze(0).cpu().float()
-                            )
-                            to_mel_cpu = train.to_mel.to("cpu")
-                            mel_pred_tensor = to_mel_cpu(audio_pred_cpu)
+                            mel_pred_tensor = train.to_mel(
+                                audio_out[inputs_index].squeeze(0).float()
+                            ).cpu()
                             mel_pred_log = torch.log(
                                 torch.clamp(mel_pred_tensor, min=1e-5)
                             )
@@ -390,28 +563,13 @@ class Stage:
         if validation is not None:
             validation.broadcast(train.manifest, train.stage, validation=True)
             total = validation.total()
+            self.val_loss = total
             if total < train.manifest.best_loss:
                 train.manifest.best_loss = total
         for key in train.model:
             train.model[key].train()
 
 
-batch_names = [
-    "audio_gt",
-    "text",
-    "text_length",
-    "ref_text",
-    "ref_length",
-    "mel",
-    "mel_length",
-    "ref_mel",
-    "path",
-    "pitch",
-    "align_mel",
-    "alignment",
-]
-
-
 def prepare_batch(
     inputs: List[Any], device: torch.device, keys_to_transfer: List[str]
 ) -> Munch:
@@ -420,7 +578,7 @@ def prepare_batch(
     """
     prepared = {}
     for i, key in enumerate(batch_names):
-        if key in keys_to_transfer:
+        if key in keys_to_transfer and inputs[i] is not None:
             if key != "paths":
                 prepared[key] = inputs[i].to(device)
             else:
@@ -428,11 +586,39 @@ def prepare_batch(
     return Munch(**prepared)
 
 
+def compute_mels(
+    batch: Munch, inputs: List[Any], device_keys: List[str], train
+) -> None:
+    """
+    Computes mel and align_mel on the device from the padded audio when the
+    loader was built with training.device_mels and so left them out.
+    """
+    if "mel" not in device_keys and "align_mel" not in device_keys:
+        return
+    if "audio_gt" in batch:
+        audio = batch.audio_gt
+    else:
+        audio = inputs[0].to(train.config.training.device)
+    # Every wave in a batch is padded to the longest, so this is the longest
+    # mel length without reading mel_length back from the device
+    frames = mel_frames(audio.shape[-1], train.model_config.hop_length)
+    # Match the silence the collater pads shorter segments with
+    lengths = inputs[6].to(train.config.training.device)
+    padding = ~sequence_mask(lengths, frames).unsqueeze(1)
+    with torch.no_grad():
+        if "mel" in device_keys:
+            mel = log_mel(train.to_mel, audio).squeeze(0)[:, :, :frames]
+            batch.mel = mel.masked_fill(padding, mel_silence)
+        if "align_mel" in device_keys:
+            align_mel = log_mel(train.to_align_mel, audio).squeeze(0)[:, :, :frames]
+            batch.align_mel = align_mel.masked_fill(padding, mel_silence)
+
+
 def prepare_model(
     model, device, training_set, eval_set, discriminators, train
 ) -> Munch:
     """
-    Prepares models for training or evaluation, attaches them to the cpu memory if unused, returns an object which contains only the models that will be used.
+    Prepares models for training or evaluation, attaches them to the cpu memory if unused, returns an object which contains only the models that will be used. Called once per stage by Stage.place_models.
     """
     result = {}
     for key in model:
@@ -448,6 +634,51 @@ def prepare_model(
     return Munch(**result)
 
 
+def take_grads(model, keys: List[str]) -> List[Optional[torch.Tensor]]:
+    """
+    Removes and returns the gradients of the parameters of each module key in keys.
+    """
+    grads = []
+    for key in keys:
+        for param in model[key].parameters():
+            grads.append(param.grad)
+            param.grad = None
+    return grads
+
+
+def restore_grads(model, keys: List[str], grads: List[Optional[torch.Tensor]]) -> None:
+    """
+    Replaces the gradients of each module key in keys with ones from take_grads.
+    """
+    params = [param for key in keys for param in model[key].parameters()]
+    for param, grad in zip(params, grads):
+        param.grad = grad
+
+
+def no_sync(accelerator, model, keys: List[str]) -> contextlib.ExitStack:
+    """
+    Skips the gradient reduction across processes for each module key in keys.
+    """
+    stack = contextlib.ExitStack()
+    for key in keys:
+        stack.enter_context(accelerator.no_sync(model[key]))
+    return stack
+
+
+def scale_grads(model, keys: List[str], scale: float) -> None:
+    """
+    Multiplies the gradients of each module key in keys by scale.
+    """
+    grads = [
+        param.grad
+        for key in keys
+        for param in model[key].parameters()
+        if param.grad is not None
+    ]
+    if len(grads) > 0:
+        torch._foreach_mul_(grads, scale)
+
+
 def optimizer_step(optimizer, keys: List[str]) -> None:
     """
     Steps the optimizer for each module key in keys.
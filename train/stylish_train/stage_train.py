@@ -1,4 +1,3 @@
-import math
 import random
 from typing import Optional, Tuple
 import torch
@@ -7,7 +6,7 @@ from einops import rearrange
 from batch_context import BatchContext
 from loss_log import LossLog, build_loss_log
 from losses import compute_duration_ce_loss
-from utils import length_to_mask, print_gpu_vram
+from utils import length_to_mask, masked_mean, print_gpu_vram
 
 
 def train_alignment(
@@ -16,7 +15,6 @@ def train_alignment(
     log = build_loss_log(train)
     mel = rearrange(batch.align_mel, "b f t -> b t f")
     ctc, _ = model.text_aligner(mel, batch.mel_length)
-    train.stage.optimizer.zero_grad()
     loss_ctc = train.align_loss(
         ctc, batch.text, batch.mel_length // 2, batch.text_length, step_type="train"
     )
@@ -25,7 +23,8 @@ def train_alignment(
         "align_loss",
         loss_ctc,
     )
-    train.accelerator.backward(log.backwards_loss() * math.sqrt(batch.text.shape[0]))
+    # Stage.train_batch scales the summed gradients by 1/sqrt(batch size)
+    train.accelerator.backward(log.backwards_loss() * batch.text.shape[0])
     return log.detach(), None
 
 
@@ -37,10 +36,9 @@ def train_acoustic(
         print_gpu_vram("init")
         pred = state.acoustic_prediction_single(batch)
         print_gpu_vram("predicted")
-        train.stage.optimizer.zero_grad()
-
         log = build_loss_log(train)
-        train.stft_loss(pred.audio.squeeze(1), batch.audio_gt, log)
+        lengths = state.sample_lengths(batch)
+        train.stft_loss(pred.audio.squeeze(1), batch.audio_gt, log, lengths)
         print_gpu_vram("stft_loss")
         log.add_loss(
             "generator",
@@ -51,19 +49,19 @@ def train_acoustic(
         print_gpu_vram("generator_loss")
         log.add_loss(
             "slm",
-            train.wavlm_loss(batch.audio_gt.detach(), pred.audio),
+            train.wavlm_loss(batch.audio_gt.detach(), pred.audio, lengths),
         )
         print_gpu_vram("slm_loss")
         if pred.magnitude is not None and pred.phase is not None:
             log.add_loss(
                 "magphase",
-                train.magphase_loss(pred.magnitude, pred.phase, batch.audio_gt),
+                train.magphase_loss(
+                    pred.magnitude, pred.phase, batch.audio_gt, lengths
+                ),
             )
         print_gpu_vram("magphase_loss")
 
-        train.accelerator.backward(
-            log.backwards_loss() * math.sqrt(batch.text.shape[0])
-        )
+        train.accelerator.backward(log.backwards_loss() * batch.text.shape[0])
         print_gpu_vram("backward")
 
     return log.detach(), pred.audio.detach()
@@ -77,9 +75,9 @@ def train_textual(
         pred = state.textual_prediction_single(batch)
         energy = state.acoustic_energy(batch.mel)
         pitch = state.calculate_pitch(batch)
-        train.stage.optimizer.zero_grad()
         log = build_loss_log(train)
-        train.stft_loss(pred.audio.squeeze(1), batch.audio_gt, log)
+        lengths = state.sample_lengths(batch)
+        train.stft_loss(pred.audio.squeeze(1), batch.audio_gt, log, lengths)
         log.add_loss(
             "generator",
             train.generator_loss(
@@ -88,30 +86,37 @@ def train_textual(
         )
         log.add_loss(
             "slm",
-            train.wavlm_loss(batch.audio_gt.detach(), pred.audio),
+            train.wavlm_loss(batch.audio_gt.detach(), pred.audio, lengths),
         )
         if pred.magnitude is not None and pred.phase is not None:
             log.add_loss(
                 "magphase",
-                train.magphase_loss(pred.magnitude, pred.phase, batch.audio_gt),
+                train.magphase_loss(
+                    pred.magnitude, pred.phase, batch.audio_gt, lengths
+                ),
             )
+        mask = state.frame_mask(batch, pitch.shape[-1])
         log.add_loss(
             "pitch",
-            torch.nn.functional.smooth_l1_loss(pitch, state.pitch_prediction),
+            masked_mean(
+                F.smooth_l1_loss(pitch, state.pitch_prediction, reduction="none"),
+                mask,
+            ),
         )
         log.add_loss(
             "energy",
-            torch.nn.functional.smooth_l1_loss(energy, state.energy_prediction),
+            masked_mean(
+                F.smooth_l1_loss(energy, state.energy_prediction, reduction="none"),
+                mask,
+            ),
         )
         loss_ce, loss_dur = compute_duration_ce_loss(
             state.duration_prediction,
-            batch.alignment.sum(dim=-1),
+            batch.duration,
             batch.text_length,
         )
         log.add_loss("duration_ce", loss_ce)
         log.add_loss("duration", loss_dur)
-        train.accelerator.backward(
-            log.backwards_loss() * math.sqrt(batch.text.shape[0])
-        )
+        train.accelerator.backward(log.backwards_loss() * batch.text.shape[0])
 
     return log.detach(), pred.audio.detach()
@@ -7,7 +7,7 @@ from einops import rearrange
 from batch_context import BatchContext
 from loss_log import build_loss_log
 from losses import compute_duration_ce_loss
-from utils import length_to_mask
+from utils import length_to_mask, masked_mean
 
 
 @torch.no_grad()
@@ -15,7 +15,6 @@ def validate_alignment(batch, train):
     log = build_loss_log(train)
     mel = rearrange(batch.align_mel, "b f t -> b t f")
     ctc, _ = train.model.text_aligner(mel, batch.mel_length)
-    train.stage.optimizer.zero_grad()
 
     loss_ctc = train.align_loss(
         ctc, batch.text, batch.mel_length // 2, batch.text_length, step_type="eval"
@@ -45,8 +44,10 @@ def validate_acoustic(batch, train):
     state = BatchContext(train=train, model=train.model)
     pred = state.acoustic_prediction_single(batch)
     log = build_loss_log(train)
-    train.stft_loss(pred.audio.squeeze(1), batch.audio_gt, log)
-    return log, batch.alignment[0], pred.audio, batch.audio_gt
+    train.stft_loss(
+        pred.audio.squeeze(1), batch.audio_gt, log, state.sample_lengths(batch)
+    )
+    return log, state.alignment(batch)[0], pred.audio, batch.audio_gt
 
 
 @torch.no_grad()
@@ -55,19 +56,28 @@ def validate_textual(batch, train):
     pred = state.textual_prediction_single(batch)
     energy = state.acoustic_energy(batch.mel)
     log = build_loss_log(train)
-    train.stft_loss(pred.audio.squeeze(1), batch.audio_gt, log)
+    train.stft_loss(
+        pred.audio.squeeze(1), batch.audio_gt, log, state.sample_lengths(batch)
+    )
+    mask = state.frame_mask(batch, batch.pitch.shape[-1])
     log.add_loss(
         "pitch",
-        torch.nn.functional.smooth_l1_loss(batch.pitch, state.pitch_prediction),
+        masked_mean(
+            F.smooth_l1_loss(batch.pitch, state.pitch_prediction, reduction="none"),
+            mask,
+        ),
     )
     log.add_loss(
-        "energy", torch.nn.functional.smooth_l1_loss(energy, state.energy_prediction)
+        "energy",
+        masked_mean(
+            F.smooth_l1_loss(energy, state.energy_prediction, reduction="none"), mask
+        ),
     )
     loss_ce, loss_dur = compute_duration_ce_loss(
         state.duration_prediction,
-        batch.alignment.sum(dim=-1),
+        batch.duration,
         batch.text_length,
     )
     log.add_loss("duration_ce", loss_ce)
     log.add_loss("duration", loss_dur)
-    return log, batch.alignment[0], pred.audio, batch.audio_gt
+    return log, state.alignment(batch)[0], pred.audio, batch.audio_gt
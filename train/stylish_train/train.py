@@ -19,7 +19,11 @@ from models.models import build_model
 from losses import GeneratorLoss, DiscriminatorLoss, WavLMLoss
 from utils import get_data_path_list, save_git_diff
 from loss_log import combine_logs
-from convert_to_onnx import convert_to_onnx
+from convert_to_onnx import (
+    convert_to_onnx,
+    convert_to_onnx_batched,
+    convert_to_onnx_split,
+)
 import tqdm
 
 import os.path as osp
@@ -74,8 +78,18 @@ class LoggerManager:
 @click.option("--checkpoint", default="", type=str)
 @click.option("--reset_stage", default=False, type=bool)
 @click.option("--convert", default=False, type=bool)
+@click.option("--convert_batch", default=False, type=bool)
+@click.option("--convert_split", default=False, type=bool)
 def main(
-    config_path, model_config_path, out_dir, stage, checkpoint, reset_stage, convert
+    config_path,
+    model_config_path,
+    out_dir,
+    stage,
+    checkpoint,
+    reset_stage,
+    convert,
+    convert_batch,
+    convert_split,
 ):
     np.random.seed(1)
     random.seed(1)
@@ -146,6 +160,8 @@ def main(
         model_config=train.model_config,
         pitch_path=train.config.dataset.pitch_path,
         alignment_path=train.config.dataset.alignment_path,
+        feature_path=train.config.dataset.feature_path,
+        device_mels=train.config.training.device_mels,
     )
     val_time_bins, _ = val_dataset.time_bins()
     train.val_dataloader = build_dataloader(
@@ -157,7 +173,9 @@ def main(
         multispeaker=train.model_config.multispeaker,
         train=train,
     )
-    train.val_dataloader = train.accelerator.prepare(train.val_dataloader)
+    train.val_dataloader = train.accelerator.prepare_data_loader(
+        train.val_dataloader, device_placement=False
+    )
 
     train.batch_manager = BatchManager(
         train.config.dataset,
@@ -233,13 +251,33 @@ def main(
         logger.info(f"Export to ONNX file {filename} complete")
         exit(0)
 
+    if convert_batch:
+        filename = convert_to_onnx_batched(
+            train.model_config,
+            train.base_output_dir,
+            train.model,
+            train.config.training.device,
+        )
+        logger.info(f"Export to ONNX file {filename} complete")
+        exit(0)
+
+    if convert_split:
+        filenames = convert_to_onnx_split(
+            train.model_config,
+            train.base_output_dir,
+            train.model,
+            train.config.training.device,
+        )
+        logger.info(f"Export to ONNX files {', '.join(filenames)} complete")
+        exit(0)
+
     done = False
     while not done:
         train.logger.info(f"Training stage {train.manifest.stage}")
         train.manifest.best_loss = float("inf")  # best test loss
         torch.cuda.synchronize()
         torch.cuda.empty_cache()
-        if not train.stage.batch_sizes_exist():
+        if train.stage.frame_budget is None and not train.stage.batch_sizes_exist():
             train.batch_manager.probe_loop(train)
             should_fast_forward = False
         train_val_loop(train, should_fast_forward=should_fast_forward)
@@ -270,6 +308,7 @@ def main(
             done = True
     if train.manifest.stage == "alignment":
         save_alignment(train)
+    train.checkpoint_writer.wait()
     train.accelerator.end_training()
 
 
@@ -310,7 +349,8 @@ def train_val_loop(train: TrainContext, should_fast_forward=False):
             train.manifest.current_total_step += 1
             train.manifest.current_step += 1
             train.manifest.total_trained_audio_seconds += (
-                float(len(batch[0][0]) * len(batch[0])) / train.model_config.sample_rate
+                float(batch[6].max() * len(batch[6]) * train.model_config.hop_length)
+                / train.model_config.sample_rate
             )
             if train.accelerator.is_main_process:
                 if next_log is not None:
@@ -329,6 +369,11 @@ def train_val_loop(train: TrainContext, should_fast_forward=False):
                 if len(logs) >= train.config.training.log_interval:
                     progress_bar.clear() if progress_bar is not None else None
                     combine_logs(logs).broadcast(train.manifest, train.stage)
+                    train.writer.add_scalar(
+                        "train/input_wait",
+                        train.batch_manager.loader.take_wait_time(),
+                        train.manifest.current_total_step,
+                    )
                     progress_bar.display() if progress_bar is not None else None
                     logs = []
             num = (
@@ -366,6 +411,7 @@ def train_val_loop(train: TrainContext, should_fast_forward=False):
         if len(logs) > 0:
             combine_logs(logs).broadcast(train.manifest, train.stage)
             logs = []
+        train.batch_manager.log_padding(train)
         train.align_loss.on_train_epoch_end(train)
         train.manifest.current_epoch += 1
         train.manifest.current_step = 0
@@ -396,10 +442,13 @@ def save_checkpoint(
     if long:
         checkpoint_dir += f"_{train.manifest.current_epoch:05d}_step_{train.manifest.current_total_step:09d}"
 
-    # Let the accelerator save all model/optimizer/LR scheduler/rng states
-    train.accelerator.save_state(checkpoint_dir, safe_serialization=False)
-
-    logger.info(f"Saved checkpoint to {checkpoint_dir}")
+    # Only a validation run since the last save scores this checkpoint
+    loss = train.stage.take_val_loss()
+    # Snapshot all model/optimizer/LR scheduler/rng states and write them
+    # in the background
+    train.checkpoint_writer.save(checkpoint_dir, loss=loss if long else None)
+    # Batch sizes adjusted since the last checkpoint
+    train.batch_manager.controller.save(train.stage)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 from stylish_lib.config_loader import Config, ModelConfig
 from batch_manager import BatchManager
+from checkpoint import CheckpointWriter
 from typing import Optional, Any
 import os.path as osp
 from accelerate import Accelerator
@@ -79,6 +80,11 @@ class TrainContext:
         self.accelerator.register_for_checkpointing(self.config)
         self.accelerator.register_for_checkpointing(self.model_config)
         self.accelerator.register_for_checkpointing(self.manifest)
+        self.checkpoint_writer: CheckpointWriter = CheckpointWriter(
+            self.accelerator,
+            keep=self.config.training.keep_checkpoints,
+            blob_dir=osp.join(self.base_output_dir, "checkpoint_blobs"),
+        )
 
         self.val_dataloader: Optional[DataLoader] = None
 
@@ -112,6 +118,13 @@ class TrainContext:
             hop_length=self.model_config.hop_length,
             sample_rate=self.model_config.sample_rate,
         ).to(self.config.training.device)
+        self.to_align_mel = torchaudio.transforms.MelSpectrogram(
+            n_mels=80,  # align seems to perform worse on higher n_mels
+            n_fft=self.model_config.n_fft,
+            win_length=self.model_config.win_length,
+            hop_length=self.model_config.hop_length,
+            sample_rate=self.model_config.sample_rate,
+        ).to(self.config.training.device)
 
     def reset_out_dir(self, stage_name):
         self.out_dir = osp.join(self.base_output_dir, stage_name)
@@ -55,6 +55,24 @@ def sequence_mask(length, max_length=None):
     return x.unsqueeze(0) < length.unsqueeze(1)
 
 
+def masked_mean(x, mask):
+    """Mean of x over the elements where mask, broadcast to x, is set"""
+    mask = mask.expand_as(x).to(x.dtype)
+    return (x * mask).sum() / mask.sum().clamp(min=1)
+
+
+def duration_to_alignment(duration: torch.Tensor, frames: int) -> torch.Tensor:
+    """
+    Expand per-token frame counts (batch, tokens) into the dense alignment
+    (batch, tokens, frames) which has a 1 where a frame belongs to a token.
+    Frames past the end of the durations are not assigned to any token.
+    """
+    end = torch.cumsum(duration, dim=-1).unsqueeze(-1)
+    start = end - duration.unsqueeze(-1)
+    positions = torch.arange(frames, device=duration.device)
+    return ((positions >= start) & (positions < end)).float()
+
+
 def length_to_mask(lengths) -> torch.Tensor:
     mask = (
         torch.arange(lengths.max())
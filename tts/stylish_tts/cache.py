@@ -0,0 +1,163 @@
+import collections
+import hashlib
+import os
+import os.path as osp
+import threading
+from typing import Optional
+
+import numpy as np
+
+
+def file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SynthesisCache:
+    """
+    Content-addressed cache of synthesized audio. Entries are keyed on the
+    hash of the model file and the token sequence, so a retrained model
+    never serves stale audio. The memory tier holds float32 arrays in LRU
+    order up to memory_bytes. The optional disk tier in disk_path holds
+    16-bit PCM files up to disk_bytes and evicts the least recently used.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        *,
+        memory_bytes=256 << 20,
+        disk_path=None,
+        disk_bytes=1 << 30,
+    ):
+        self.model_hash = file_digest(model_path)
+        self.memory_bytes = memory_bytes
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.disk_path = disk_path
+        self.disk_bytes = disk_bytes
+        self.disk = collections.OrderedDict()
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+            self.load_disk_index()
+
+    def load_disk_index(self):
+        entries = []
+        for name in os.listdir(self.disk_path):
+            if not name.endswith(".pcm"):
+                continue
+            stat = os.stat(osp.join(self.disk_path, name))
+            entries.append((stat.st_mtime, name[: -len(".pcm")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_size += size
+
+    def key(self, tokens: np.ndarray) -> str:
+        digest = hashlib.sha256(self.model_hash.encode("ascii"))
+        digest.update(tokens.astype("<i8").tobytes())
+        return digest.hexdigest()
+
+    def disk_file(self, key) -> str:
+        return osp.join(self.disk_path, f"{key}.pcm")
+
+    def get(self, tokens: np.ndarray) -> Optional[np.ndarray]:
+        key = self.key(tokens)
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return audio
+            on_disk = key in self.disk
+            if on_disk:
+                self.disk.move_to_end(key)
+        if on_disk:
+            audio = self.read_disk(key)
+            if audio is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                self.put_memory(key, audio)
+                return audio
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, tokens: np.ndarray, audio: np.ndarray):
+        key = self.key(tokens)
+        audio.setflags(write=False)
+        self.put_memory(key, audio)
+        if self.disk_path is not None:
+            self.write_disk(key, audio)
+
+    def put_memory(self, key, audio):
+        if audio.nbytes > self.memory_bytes:
+            return
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = audio
+            self.memory_size += audio.nbytes
+            while self.memory_size > self.memory_bytes:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= evicted.nbytes
+
+    def read_disk(self, key) -> Optional[np.ndarray]:
+        path = self.disk_file(key)
+        try:
+            pcm = np.fromfile(path, dtype="<i2")
+            os.utime(path)
+        except OSError:
+            # Removed by another process sharing the directory
+            with self.lock:
+                size = self.disk.pop(key, None)
+                if size is not None:
+                    self.disk_size -= size
+            return None
+        audio = pcm.astype(np.float32) / 32767
+        audio.setflags(write=False)
+        return audio
+
+    def write_disk(self, key, audio):
+        with self.lock:
+            if key in self.disk:
+                return
+        pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2")
+        if pcm.nbytes > self.disk_bytes:
+            return
+        path = self.disk_file(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pcm.tofile(tmp_path)
+        os.replace(tmp_path, path)
+        evicted = []
+        with self.lock:
+            self.disk[key] = pcm.nbytes
+            self.disk_size += pcm.nbytes
+            while self.disk_size > self.disk_bytes:
+                old_key, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self.disk_file(old_key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_size,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_size,
+            }
@@ -0,0 +1,165 @@
+import queue
+import threading
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from stylish_lib.text_utils import TextCleaner
+from stylish_tts.synthesizer import SessionPool, warmup_phonemes
+
+feature_names = ["mel", "style", "pitch", "energy"]
+
+
+class PipelinedSynthesizer:
+    """
+    Runs the split stylish_frontend.onnx and stylish_vocoder.onnx graphs
+    as a two stage pipeline. A background thread runs the front end for
+    utterance N+1 while the calling thread vocodes utterance N.
+
+    The vocoder runs Conformer attention over every frame it is given, so
+    long utterances are vocoded in windows of vocoder_window frames. Each
+    window is run with up to vocoder_context extra frames on either side,
+    which are discarded, and neighbouring windows share vocoder_overlap
+    frames which are crossfaded. Set vocoder_window to None to vocode whole
+    utterances.
+    """
+
+    def __init__(
+        self,
+        front_end_path,
+        vocoder_path,
+        model_config,
+        *,
+        intra_op_threads=1,
+        inter_op_threads=1,
+        providers=None,
+        queue_size=2,
+        vocoder_window=200,
+        vocoder_context=20,
+        vocoder_overlap=8,
+    ):
+        assert (
+            vocoder_window is None or vocoder_window > vocoder_overlap
+        ), "vocoder_window must be longer than vocoder_overlap"
+        if providers is None:
+            providers = ["CPUExecutionProvider"]
+        self.sample_rate = model_config.sample_rate
+        self.text_cleaner = TextCleaner(model_config.symbol)
+        self.queue_size = queue_size
+        self.hop_length = model_config.hop_length
+        self.vocoder_window = vocoder_window
+        self.vocoder_context = vocoder_context
+        self.vocoder_overlap = vocoder_overlap
+        self.front_end = SessionPool(
+            front_end_path,
+            size=1,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+            providers=providers,
+        )
+        self.vocoder = SessionPool(
+            vocoder_path,
+            size=1,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+            providers=providers,
+        )
+        self.run_vocoder(self.run_front_end(warmup_phonemes))
+
+    def run_front_end(self, phonemes: str) -> dict:
+        tokens = np.pad(self.text_cleaner.encode(phonemes), 1)
+        inputs = {
+            "texts": tokens[np.newaxis, :],
+            "text_lengths": np.array([tokens.shape[0]], dtype=np.int64),
+        }
+        with self.front_end.session() as session:
+            outputs = session.run(feature_names, inputs)
+        return dict(zip(feature_names, outputs))
+
+    def run_vocoder(self, features: dict) -> np.ndarray:
+        return np.concatenate(list(self.iter_vocoder(features)))
+
+    def iter_vocoder(self, features: dict) -> Iterator[np.ndarray]:
+        """Yield the audio for one utterance in order, a window at a time."""
+        frames = features["mel"].shape[2]
+        if self.vocoder_window is None or frames <= self.vocoder_window:
+            yield self.vocode(features)
+            return
+        # Give the style one entry per frame so it can be cut like the rest
+        style = features["style"]
+        index = np.arange(frames) * style.shape[2] // frames
+        features = dict(features, style=style[:, :, index])
+        hop = self.hop_length
+        overlap = self.vocoder_overlap * hop
+        fade = np.linspace(0.0, 1.0, overlap, dtype=np.float32)
+        tail = None
+        start = 0
+        while True:
+            stop = min(start + self.vocoder_window, frames)
+            left = max(start - self.vocoder_context, 0)
+            right = min(stop + self.vocoder_context, frames)
+            audio = self.vocode(
+                {
+                    "mel": features["mel"][:, :, left:right],
+                    "style": features["style"][:, :, left:right],
+                    "pitch": features["pitch"][:, left:right],
+                    "energy": features["energy"][:, left:right],
+                }
+            )
+            audio = audio[(start - left) * hop : (stop - left) * hop]
+            if tail is not None:
+                length = min(tail.shape[0], audio.shape[0])
+                head = tail[:length] * (1.0 - fade[:length])
+                head += audio[:length] * fade[:length]
+                audio = np.concatenate([head, audio[length:]])
+            if stop >= frames:
+                yield audio
+                return
+            yield audio[:-overlap]
+            tail = audio[-overlap:]
+            start = stop - self.vocoder_overlap
+
+    def vocode(self, features: dict) -> np.ndarray:
+        with self.vocoder.session() as session:
+            # The exporter drops graph inputs the generator does not read
+            inputs = {i.name: features[i.name] for i in session.get_inputs()}
+            outputs = session.run(None, inputs)
+        return outputs[0].astype(np.float32).reshape(-1)
+
+    def synthesize(self, phonemes: str) -> np.ndarray:
+        return self.run_vocoder(self.run_front_end(phonemes))
+
+    def synthesize_all(self, utterances: Iterable[str]) -> Iterator[np.ndarray]:
+        """Yield the audio for each utterance in order."""
+        features = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for phonemes in utterances:
+                    if stop.is_set():
+                        return
+                    features.put(self.run_front_end(phonemes))
+            except Exception as e:
+                features.put(e)
+            finally:
+                features.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = features.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield self.run_vocoder(item)
+        finally:
+            stop.set()
+            # Unblock the producer if it is waiting on a full queue
+            while producer.is_alive():
+                try:
+                    features.get(timeout=0.1)
+                except queue.Empty:
+                    pass
@@ -0,0 +1,284 @@
+import json
+import logging
+import os
+import os.path as osp
+import socketserver
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+from stylish_lib.config_loader import load_model_config_yaml
+from stylish_tts.cache import SynthesisCache
+from stylish_tts.stream import StreamingSynthesizer
+from stylish_tts.synthesizer import Synthesizer, to_pcm16
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadingUnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+
+class SynthesisHandler(BaseHTTPRequestHandler):
+    """
+    POST /synthesize with either a JSON body {"phonemes": "..."} or a plain
+    text body of phonemes. The response is mono 16-bit little-endian PCM at
+    the model sample rate.
+
+    POST /stream takes the same body and writes the PCM clause by clause as
+    it is synthesized. The response has no Content-Length and ends when the
+    connection is closed.
+
+    Input without any known phonemes gets a 400 response and a failed
+    synthesis a 500 one, both with a JSON error. Once a stream has started
+    its status can not change, so a failure ends it early instead.
+    """
+
+    synthesizer: Synthesizer = None
+    streamer: StreamingSynthesizer = None
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        status = {
+            "sessions": self.synthesizer.pool.size,
+            "sample_rate": self.synthesizer.sample_rate,
+        }
+        if self.synthesizer.cache is not None:
+            status["cache"] = self.synthesizer.cache.stats()
+        self.send_json(HTTPStatus.OK, status)
+
+    def do_POST(self):
+        if self.path == "/stream":
+            self.stream()
+            return
+        if self.path != "/synthesize":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        phonemes = self.read_phonemes()
+        if phonemes is None:
+            return
+        tokens = self.tokenize(phonemes)
+        if tokens is None:
+            return
+        try:
+            audio = self.synthesizer.synthesize_tokens(tokens)
+        except Exception:
+            logger.exception("Synthesis failed")
+            self.send_json(
+                HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Synthesis failed"}
+            )
+            return
+        pcm = to_pcm16(audio)
+        self.send_response(HTTPStatus.OK)
+        self.send_header(
+            "Content-Type",
+            f"audio/L16; rate={self.synthesizer.sample_rate}; channels=1",
+        )
+        self.send_header("Content-Length", str(len(pcm)))
+        self.end_headers()
+        self.wfile.write(pcm)
+
+    def stream(self):
+        phonemes = self.read_phonemes()
+        if phonemes is None or self.tokenize(phonemes) is None:
+            return
+        pieces = self.streamer.stream(phonemes)
+        try:
+            # The first clause decides the status
+            audio = next(pieces, None)
+        except Exception:
+            logger.exception("Synthesis failed")
+            self.send_json(
+                HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Synthesis failed"}
+            )
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header(
+            "Content-Type",
+            f"audio/L16; rate={self.synthesizer.sample_rate}; channels=1",
+        )
+        self.end_headers()
+        try:
+            while audio is not None:
+                self.wfile.write(to_pcm16(audio))
+                self.wfile.flush()
+                audio = next(pieces, None)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("Stream client disconnected")
+        except Exception:
+            logger.exception("Synthesis failed, ending the stream early")
+        finally:
+            # Cancels the clauses queued for this stream
+            pieces.close()
+            self.close_connection = True
+
+    def read_phonemes(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        phonemes = body
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                phonemes = json.loads(body)["phonemes"]
+            except (ValueError, KeyError, TypeError):
+                self.send_json(
+                    HTTPStatus.BAD_REQUEST,
+                    {"error": 'Expected a JSON object with a "phonemes" field'},
+                )
+                return None
+        phonemes = phonemes.strip()
+        if len(phonemes) == 0:
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": "No phonemes provided"})
+            return None
+        return phonemes
+
+    def tokenize(self, phonemes):
+        tokens = self.synthesizer.tokenize(phonemes)
+        # Only the padding either side is left when no symbol is known
+        if tokens.shape[0] <= 2:
+            self.send_json(
+                HTTPStatus.BAD_REQUEST, {"error": "No known phonemes provided"}
+            )
+            return None
+        return tokens
+
+    def send_json(self, status, value):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@click.command()
+@click.option("-cp", "--model_config_path", default="config/model.config.yml", type=str)
+@click.option("-m", "--model_path", default="stylish.onnx", type=str)
+@click.option("--host", default="127.0.0.1", type=str)
+@click.option("--port", default=8330, type=int)
+@click.option(
+    "--socket",
+    "socket_path",
+    default="",
+    type=str,
+    help="Serve on this Unix socket instead of TCP.",
+)
+@click.option(
+    "--sessions",
+    default=os.cpu_count() or 1,
+    type=int,
+    help="Number of InferenceSessions, i.e. concurrently running requests.",
+)
+@click.option("--intra_op_threads", default=1, type=int)
+@click.option("--inter_op_threads", default=1, type=int)
+@click.option("--cuda", is_flag=True, help="Use the CUDA execution provider.")
+@click.option(
+    "--cache_mb",
+    default=256,
+    type=int,
+    help="Memory for cached audio of repeated prompts. 0 disables the cache.",
+)
+@click.option(
+    "--cache_dir",
+    default="",
+    type=str,
+    help="Also keep cached audio on disk in this directory.",
+)
+@click.option("--cache_dir_mb", default=1024, type=int)
+@click.option(
+    "--max_chunk_length",
+    default=200,
+    type=int,
+    help="Longest chunk of phonemes synthesized at once by /stream.",
+)
+@click.option(
+    "--first_chunk_length",
+    default=50,
+    type=int,
+    help="Longest first chunk of /stream, which bounds time-to-first-audio.",
+)
+def main(
+    model_config_path,
+    model_path,
+    host,
+    port,
+    socket_path,
+    sessions,
+    intra_op_threads,
+    inter_op_threads,
+    cuda,
+    cache_mb,
+    cache_dir,
+    cache_dir_mb,
+    max_chunk_length,
+    first_chunk_length,
+):
+    if not osp.exists(model_config_path):
+        exit(f"Model config not found at {model_config_path}")
+    if not osp.exists(model_path):
+        exit(f"ONNX model not found at {model_path}")
+    model_config = load_model_config_yaml(model_config_path)
+
+    providers = ["CPUExecutionProvider"]
+    if cuda:
+        providers = ["CUDAExecutionProvider"] + providers
+    cache = None
+    if cache_mb > 0:
+        cache = SynthesisCache(
+            model_path,
+            memory_bytes=cache_mb << 20,
+            disk_path=cache_dir if cache_dir else None,
+            disk_bytes=cache_dir_mb << 20,
+        )
+    logger.info(f"Loading {sessions} sessions of {model_path}")
+    SynthesisHandler.synthesizer = Synthesizer(
+        model_path,
+        model_config,
+        sessions=sessions,
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=inter_op_threads,
+        providers=providers,
+        cache=cache,
+    )
+    SynthesisHandler.streamer = StreamingSynthesizer(
+        SynthesisHandler.synthesizer,
+        model_config.symbol.punctuation,
+        max_chunk_length=max_chunk_length,
+        first_chunk_length=first_chunk_length,
+    )
+
+    if socket_path:
+        if osp.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, SynthesisHandler)
+        logger.info(f"Serving on unix:{socket_path}")
+    else:
+        server = ThreadingHTTPServer((host, port), SynthesisHandler)
+        logger.info(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and osp.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    main()
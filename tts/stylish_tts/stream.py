@@ -0,0 +1,131 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+
+import numpy as np
+
+from stylish_tts.synthesizer import Synthesizer
+
+
+class StreamingSynthesizer:
+    """
+    Synthesizes long phoneme input as a sequence of clauses so that playback
+    can start as soon as the first clause is ready. Input is split after
+    punctuation from SymbolConfig.punctuation, clauses are merged up to
+    max_chunk_length phonemes, and the first chunk is kept under
+    first_chunk_length to bound time-to-first-audio. Chunks are synthesized
+    ahead of playback on the synthesizer's session pool and neighbouring
+    chunks are crossfaded. The worker threads are shared by every stream,
+    one per session, and each stream keeps at most lookahead chunks in
+    flight so that concurrent streams take turns on the sessions.
+    """
+
+    def __init__(
+        self,
+        synthesizer: Synthesizer,
+        punctuation: str,
+        *,
+        max_chunk_length=200,
+        first_chunk_length=50,
+        crossfade_ms=20,
+        lookahead=2,
+    ):
+        self.synthesizer = synthesizer
+        self.break_marks = set(c for c in punctuation if not c.isspace())
+        self.max_chunk_length = max_chunk_length
+        self.first_chunk_length = first_chunk_length
+        self.crossfade = synthesizer.sample_rate * crossfade_ms // 1000
+        self.lookahead = lookahead
+        self.executor = ThreadPoolExecutor(max_workers=synthesizer.pool.size)
+
+    def clauses(self, phonemes: str) -> List[str]:
+        """Split after punctuation which is followed by whitespace."""
+        result = []
+        start = 0
+        for i in range(1, len(phonemes)):
+            if phonemes[i].isspace() and phonemes[i - 1] in self.break_marks:
+                result.append(phonemes[start:i].strip())
+                start = i
+        result.append(phonemes[start:].strip())
+        return [clause for clause in result if len(clause) > 0]
+
+    def split_long(self, text: str, limit: int) -> List[str]:
+        """Split text longer than limit at spaces, or anywhere if it must."""
+        result = []
+        while len(text) > limit:
+            cut = text.rfind(" ", 0, limit + 1)
+            if cut <= 0:
+                cut = limit
+            result.append(text[:cut].strip())
+            text = text[cut:].strip()
+        if len(text) > 0:
+            result.append(text)
+        return result
+
+    def chunks(self, phonemes: str) -> List[str]:
+        result = []
+        current = ""
+        for clause in self.clauses(phonemes):
+            limit = self.max_chunk_length
+            if len(result) == 0:
+                limit = self.first_chunk_length
+            if len(current) > 0 and len(current) + 1 + len(clause) <= limit:
+                current = current + " " + clause
+                continue
+            if len(current) > 0:
+                result.append(current)
+                limit = self.max_chunk_length
+            pieces = self.split_long(clause, limit)
+            if len(pieces) > 1 and limit != self.max_chunk_length:
+                result.append(pieces[0])
+                rest = clause[len(pieces[0]) :].strip()
+                pieces = self.split_long(rest, self.max_chunk_length)
+            result.extend(pieces[:-1])
+            current = pieces[-1]
+        if len(current) > 0:
+            result.append(current)
+        return result
+
+    def stream(self, phonemes: str) -> Iterator[np.ndarray]:
+        """
+        Yield float32 audio in playback order. The final crossfade tail of
+        each chunk is held back until the next chunk is ready.
+        """
+        pending = collections.deque()
+        chunks = iter(self.chunks(phonemes))
+        for chunk in chunks:
+            pending.append(self.submit(chunk))
+            if len(pending) >= self.lookahead:
+                break
+
+        tail = None
+        try:
+            while len(pending) > 0:
+                audio = pending.popleft().result()
+                for chunk in chunks:
+                    pending.append(self.submit(chunk))
+                    break
+                if tail is not None:
+                    audio = self.blend(tail, audio)
+                if audio.shape[0] > self.crossfade:
+                    yield audio[: -self.crossfade]
+                    tail = audio[-self.crossfade :]
+                else:
+                    tail = audio
+        finally:
+            # A closed stream (such as a client disconnecting) gives up
+            # the chunks it queued so they do not hold up other streams
+            for future in pending:
+                future.cancel()
+        if tail is not None:
+            yield tail
+
+    def submit(self, chunk):
+        tokens = self.synthesizer.tokenize(chunk)
+        return self.executor.submit(self.synthesizer.synthesize_tokens, tokens)
+
+    def blend(self, tail: np.ndarray, audio: np.ndarray) -> np.ndarray:
+        length = min(tail.shape[0], audio.shape[0])
+        fade = np.linspace(0.0, 1.0, length, dtype=np.float32)
+        head = tail[-length:] * (1.0 - fade) + audio[:length] * fade
+        return np.concatenate([tail[: tail.shape[0] - length], head, audio[length:]])
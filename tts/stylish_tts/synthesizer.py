@@ -0,0 +1,134 @@
+import contextlib
+import queue
+
+import numpy as np
+import onnxruntime as ort
+
+from stylish_lib.text_utils import TextCleaner
+
+warmup_phonemes = "həlˈoʊ wˈɜːld ."
+
+
+def build_session_options(intra_op_threads, inter_op_threads):
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    else:
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+
+class SessionPool:
+    """
+    Fixed-size pool of InferenceSessions for one ONNX model. A session is
+    only ever used by one request at a time so that the per-session thread
+    settings hold under concurrent load. Callers block when every session is
+    busy.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        *,
+        size,
+        intra_op_threads,
+        inter_op_threads,
+        providers,
+    ):
+        self.model_path = model_path
+        self.size = size
+        self.sessions = queue.Queue()
+        for _ in range(size):
+            session = ort.InferenceSession(
+                model_path,
+                sess_options=build_session_options(intra_op_threads, inter_op_threads),
+                providers=providers,
+            )
+            self.sessions.put(session)
+
+    @contextlib.contextmanager
+    def session(self):
+        session = self.sessions.get()
+        try:
+            yield session
+        finally:
+            self.sessions.put(session)
+
+    def warmup(self, inputs):
+        """
+        Run every session once so the first real request does not pay for
+        memory arena allocation and kernel selection.
+        """
+        held = [self.sessions.get() for _ in range(self.size)]
+        try:
+            for session in held:
+                session.run(None, inputs)
+        finally:
+            for session in held:
+                self.sessions.put(session)
+
+
+class Synthesizer:
+    """
+    Long-lived synthesizer for the stylish.onnx model produced by
+    convert_to_onnx. Phoneme strings go in, float32 waveforms come out.
+    If a SynthesisCache is given, repeated token sequences are served from it.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        model_config,
+        *,
+        sessions=1,
+        intra_op_threads=1,
+        inter_op_threads=1,
+        providers=None,
+        cache=None,
+    ):
+        if providers is None:
+            providers = ["CPUExecutionProvider"]
+        self.model_path = model_path
+        self.cache = cache
+        self.sample_rate = model_config.sample_rate
+        self.text_cleaner = TextCleaner(model_config.symbol)
+        self.pool = SessionPool(
+            model_path,
+            size=sessions,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+            providers=providers,
+        )
+        self.pool.warmup(self.inputs(self.tokenize(warmup_phonemes)))
+
+    def tokenize(self, phonemes: str) -> np.ndarray:
+        return np.pad(self.text_cleaner.encode(phonemes), 1)
+
+    def inputs(self, tokens: np.ndarray) -> dict:
+        return {
+            "texts": tokens[np.newaxis, :],
+            "text_lengths": np.array([tokens.shape[0]], dtype=np.int64),
+        }
+
+    def synthesize_tokens(self, tokens: np.ndarray) -> np.ndarray:
+        if self.cache is not None:
+            audio = self.cache.get(tokens)
+            if audio is not None:
+                return audio
+        with self.pool.session() as session:
+            outputs = session.run(None, self.inputs(tokens))
+        audio = outputs[0].astype(np.float32).reshape(-1)
+        if self.cache is not None:
+            self.cache.put(tokens, audio)
+        return audio
+
+    def synthesize(self, phonemes: str) -> np.ndarray:
+        return self.synthesize_tokens(self.tokenize(phonemes))
+
+
+def to_pcm16(audio: np.ndarray) -> bytes:
+    """Convert a float waveform in [-1, 1] to little-endian 16-bit PCM."""
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2").tobytes()